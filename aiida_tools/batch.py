@@ -0,0 +1,93 @@
+from itertools import islice
+from os.path import splitext
+import json
+import time
+
+from aiida import orm
+from aiida.engine import submit
+from aiida.manage import get_manager
+from ruamel.yaml import YAML
+
+from .workflows.declarative_chain import DeclarativeChain
+
+ACTIVE_STATES = ('created', 'waiting', 'running')
+
+
+def read_overrides(path):
+    """
+    Yields the override dicts stored in a json lines file, a json file holding a
+    list, or a yaml file holding one or more documents, each a dict or a list of dicts.
+    """
+    ext = splitext(path)[1]
+    with open(path) as f:
+        if ext == '.jsonl':
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        documents = YAML(typ='safe').load_all(f) if ext in ('.yaml', '.yml') else [json.load(f)]
+        for document in documents:
+            if isinstance(document, list):
+                yield from document
+            elif document is not None:
+                yield document
+
+
+def active_processes(pks):
+    """The pks among `pks` of the processes that did not terminate yet."""
+    if not pks:
+        return set()
+    qb = orm.QueryBuilder().append(
+        orm.ProcessNode, filters={'id': {'in': list(pks)}, 'attributes.process_state': {'in': list(ACTIVE_STATES)}}, project='id'
+    )
+    return set(qb.all(flat=True))
+
+
+def submit_batch(specification, overrides, max_active=100, chunk_size=100, poll_interval=5.0, group=None, **inputs):
+    """
+    Submits a DeclarativeChain for every dict in the iterable `overrides`, all
+    sharing the same `specification` node (or file), with the dict as their
+    `overrides` input. The specification is validated once up front. The
+    `overrides` nodes are stored `chunk_size` at a time in a single transaction,
+    and no new chain is submitted while `max_active` chains of the batch are
+    still running. The chains are added to `group` if given, and the other
+    `inputs` are passed to all of them. Returns the submitted nodes.
+    """
+    if not isinstance(specification, orm.SinglefileData):
+        specification = orm.SinglefileData(specification)
+    if not specification.is_stored:
+        specification.store()
+    DeclarativeChain.load_specification(specification)
+
+    storage = get_manager().get_profile_storage()
+    overrides = iter(overrides)
+    active = set()
+    nodes = []
+    while True:
+        chunk = list(islice(overrides, chunk_size))
+        if not chunk:
+            break
+        for i, o in enumerate(chunk):
+            if not isinstance(o, dict):
+                raise TypeError(f'The overrides of chain {len(nodes) + i} should be a dict, not a {type(o).__name__}.')
+
+        with storage.transaction():
+            dicts = [orm.Dict(o).store() for o in chunk]
+
+        submitted = []
+        for d in dicts:
+            if len(active) >= max_active:
+                active = active_processes(active)
+            while len(active) >= max_active:
+                time.sleep(poll_interval)
+                active = active_processes(active)
+            node = submit(DeclarativeChain, workchain_specification=specification, overrides=d, **inputs)
+            active.add(node.pk)
+            submitted.append(node)
+
+        if group is not None:
+            group.add_nodes(submitted)
+        nodes.extend(submitted)
+
+    return nodes
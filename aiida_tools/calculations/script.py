@@ -1,11 +1,144 @@
 from aiida.common.datastructures import CalcInfo, CodeInfo
+from aiida.common.escaping import escape_for_bash
 from aiida.common.folders import Folder
 from aiida.engine import CalcJob, CalcJobProcessSpec, ExitCode
-from aiida.orm import Dict, SinglefileData, Code
-from os.path import splitext
+from aiida.engine.processes.calcjobs.calcjob import validate_calc_job
+from aiida.orm import Dict, SinglefileData, FolderData, RemoteData, Code, Bool, Int, ArrayData
+from contextlib import contextmanager
+from os.path import splitext, join, isfile
+import numpy as np
+import shutil
+import zipfile
 import json
 
 
+def context_patch(before, after):
+    """
+    The changes from the context `before` to `after`, as `{'set': {...}, 'unset': [...]}`
+    on the top level keys, or None if nothing changed.
+    """
+    changed = {k: v for k, v in after.items() if k not in before or before[k] != v}
+    removed = [k for k in before if k not in after]
+    if not changed and not removed:
+        return None
+    return {'set': changed, 'unset': removed}
+
+
+def apply_context_patch(context, patch):
+    """Applies a patch created by `context_patch` to the dict `context` in place."""
+    for k in patch.get('unset', []):
+        context.pop(k, None)
+    context.update(patch.get('set', {}))
+    return context
+
+
+def patched_context(context, patches=None):
+    """The dict obtained by applying the `patches` namespace, in the order of its integer keys, to the `context` Dict."""
+    d = context.get_dict()
+    for k in sorted(patches or {}, key=int):
+        apply_context_patch(d, patches[k].get_dict())
+    return d
+
+
+def npy_shape(handle):
+    """Reads the shape of the array in a .npy file from its header, without reading the data."""
+    version = np.lib.format.read_magic(handle)
+    if version == (1, 0):
+        shape, _, dtype = np.lib.format.read_array_header_1_0(handle)
+    elif version == (2, 0):
+        shape, _, dtype = np.lib.format.read_array_header_2_0(handle)
+    else:
+        raise ValueError(f'Unsupported .npy format version {version}.')
+
+    if dtype.hasobject:
+        raise ValueError('Arrays of python objects can not be stored.')
+    return shape
+
+
+def add_npy(arrays, name, open_npy):
+    """
+    Copies a .npy file into the ArrayData `arrays` as the array `name`. The file
+    is streamed into the repository as is, only its header is parsed. `open_npy`
+    returns a new binary handle to the file every time it is called.
+    """
+    with open_npy() as handle:
+        shape = npy_shape(handle)
+    with open_npy() as handle:
+        arrays.base.repository.put_object_from_filelike(handle, f'{name}.npy')
+    arrays.base.attributes.set(f'{arrays.array_prefix}{name}', list(shape))
+
+
+@contextmanager
+def mmap_array(arrays, name='results'):
+    """
+    Memory maps the array `name` of the ArrayData `arrays`, as a read-only numpy
+    array that is only valid inside the `with` block. The .npy file is streamed
+    out of the repository into a temporary file, so that the array is read from
+    disk as it is accessed instead of being loaded in memory by `get_array`.
+    """
+    with arrays.base.repository.as_path(f'{name}.npy') as path:
+        yield np.load(path, mmap_mode='r')
+
+
+def parse_arrays(folder, stem):
+    """
+    Builds an ArrayData from the `<stem>.npy` or `<stem>.npz` file in the
+    directory `folder`. A .npy file is stored as the array `results`, the
+    arrays in a .npz file keep their names. Returns None if there is no such file.
+    """
+    npy = join(folder, stem + '.npy')
+    npz = join(folder, stem + '.npz')
+    if isfile(npy):
+        arrays = ArrayData()
+        add_npy(arrays, 'results', lambda: open(npy, 'rb'))
+        return arrays
+    elif isfile(npz):
+        arrays = ArrayData()
+        with zipfile.ZipFile(npz) as archive:
+            for member in archive.namelist():
+                if member.endswith('.npy'):
+                    add_npy(arrays, member[:-4], lambda: archive.open(member))
+        return arrays
+    return None
+
+
+def local_copy_list(script, files=None):
+    """
+    Instructions for the engine to copy the script and the extra `files` from the
+    repository into the working directory, without loading them in memory.
+    SinglefileData keep their filename, the contents of a FolderData end up in a
+    directory named after its key in `files`.
+    """
+    copy_list = [(script.uuid, script.filename, script.filename)]
+    for key, node in (files or {}).items():
+        if isinstance(node, SinglefileData):
+            copy_list.append((node.uuid, node.filename, node.filename))
+        else:
+            copy_list.append((node.uuid, '', key))
+    return copy_list
+
+
+def remote_copy_lists(parent_folders, symlink):
+    """
+    The remote copy and symlink lists that make the working directories in
+    `parent_folders` available as directories named after their keys.
+    """
+    instructions = [(f.computer.uuid, f.get_remote_path(), key) for key, f in (parent_folders or {}).items()]
+    return ([], instructions) if symlink else (instructions, [])
+
+
+def validate_parent_folders(inputs, ctx):
+    """Runs the default CalcJob validation, and checks that the parent folders are on the computer that runs the script."""
+    message = validate_calc_job(inputs, ctx)
+    if message:
+        return message
+
+    computer = inputs['code'].computer if 'code' in inputs else None
+    for key, folder in inputs.get('parent_folders', {}).items():
+        if computer is not None and folder.computer.uuid != computer.uuid:
+            return f'ERROR: parent folder {key} is on computer {folder.computer.label}, not on {computer.label}.'
+
+
 class Script(CalcJob):
     """
     A simple CalcJob that runs the script using the specified code. The parameters
@@ -15,6 +148,21 @@ class Script(CalcJob):
 
     Since the context Dict is passed as both in and output, this can be used
     to communicate variables between scripts.
+
+    Extra input files of the script can be given in the `files` namespace.
+    The working directories of previous calculations on the same computer,
+    given in the `parent_folders` namespace, are symlinked (or copied) into
+    directories named after their keys, so that files can be passed between
+    scripts without them leaving the remote machine.
+
+    Array results can be written to a .npy or .npz file with the name of the
+    results file, but the extension replaced, e.g. `script_results.npz`. They
+    are stored in the `arrays` output without being loaded in memory.
+
+    With `delta_context`, the context given to the script is `context` with the
+    `context_patches` applied in order, and only the changes the script made to it
+    are stored, as the `context_patch` output. Nothing is stored if the script
+    did not change the context.
     """
     @classmethod
     def define(cls, spec: CalcJobProcessSpec):
@@ -22,10 +170,28 @@ class Script(CalcJob):
         spec.input('script',         valid_type=SinglefileData)
         spec.input('parameters',     valid_type=Dict)
         spec.input('context',        valid_type=Dict)
+        spec.input_namespace('context_patches', valid_type=Dict, dynamic=True, required=False,
+                             help='Patches applied to the context, in the order of their integer keys.')
+        spec.input('delta_context',  valid_type=Bool, default=lambda: Bool(False),
+                   help='Store only the changes the script made to the context, as the `context_patch` output.')
         spec.input('code',           valid_type=Code)
         spec.input('cmdline_params', required=False)
+        spec.input_namespace('files', valid_type=(SinglefileData, FolderData), dynamic=True, required=False,
+                             help='Extra files copied next to the script, folders are copied into a directory named after their key.')
+        spec.input_namespace('parent_folders', valid_type=RemoteData, dynamic=True, required=False,
+                             help='Remote working directories made available in directories named after their key.')
+        spec.input('symlink_parents', valid_type=Bool, default=lambda: Bool(True),
+                   help='Symlink the parent folders rather than copying them.')
+        spec.input('retrieve_arrays', valid_type=Bool, default=lambda: Bool(True),
+                   help='Retrieve the array results, if False they are only left in the remote working directory.')
+        spec.inputs.validator = validate_parent_folders
         spec.output('results',       valid_type=Dict)
-        spec.output('context',       valid_type=Dict)
+        spec.output('context',       valid_type=Dict, required=False)
+        spec.output('context_patch', valid_type=Dict, required=False)
+        spec.output('arrays',        valid_type=ArrayData, required=False)
+        spec.exit_code(300, 'ERROR_READING_OUTPUT_FILE', message='The results file could not be read.')
+        spec.exit_code(301, 'ERROR_INVALID_OUTPUT', message='The results file does not contain a json object.')
+        spec.exit_code(303, 'ERROR_INVALID_ARRAYS', message='The array results file could not be read.')
 
     def prepare_for_submission(self, folder: Folder) -> CalcInfo:
      
@@ -42,10 +208,7 @@ class Script(CalcJob):
             json.dump(self.inputs['parameters'].get_dict(), params_file)
 
         with folder.open(cname, 'w') as context_file:
-            json.dump(self.inputs['context'].get_dict(), context_file)
-
-        with folder.open(self.inputs.script.filename, 'w') as script_file:
-            script_file.write(self.inputs.script.get_content())
+            json.dump(patched_context(self.inputs['context'], self.inputs.get('context_patches')), context_file)
 
         if 'cmdline_params' in self.inputs:
             codeinfo.cmdline_params = [self.inputs.script.filename, pname, cname, rname] + self.inputs.cmdline_params
@@ -54,11 +217,31 @@ class Script(CalcJob):
 
         calcinfo = CalcInfo()
         calcinfo.codes_info = [codeinfo]
-        calcinfo.retrieve_list = [codeinfo.stdout_name, cname, rname]
+        calcinfo.local_copy_list = local_copy_list(self.inputs.script, self.inputs.get('files'))
+        calcinfo.remote_copy_list, calcinfo.remote_symlink_list = remote_copy_lists(self.inputs.get('parent_folders'), self.inputs['symlink_parents'].value)
+        calcinfo.retrieve_list = [codeinfo.stdout_name, rname]
+        calcinfo.retrieve_temporary_list = []
+        # Arrays are only stored in the arrays output, not in the retrieved folder as well
+        if self.inputs['retrieve_arrays'].value:
+            calcinfo.retrieve_temporary_list += [fname + '_results.npy', fname + '_results.npz']
+        # With delta_context only the patch is stored, not the full context going in or out
+        if self.inputs['delta_context'].value:
+            calcinfo.provenance_exclude_list = [cname]
+            calcinfo.retrieve_temporary_list.append(cname)
+        else:
+            calcinfo.retrieve_list.append(cname)
 
         return calcinfo
 
-    def parse(self, folder):
+    def parse(self, retrieved_temporary_folder=None, existing_exit_code=None):
+        # Overriding CalcJob.parse skips its removal of the temporary folder
+        try:
+            return self.parse_outputs(retrieved_temporary_folder)
+        finally:
+            if retrieved_temporary_folder is not None:
+                shutil.rmtree(retrieved_temporary_folder, ignore_errors=True)
+
+    def parse_outputs(self, retrieved_temporary_folder=None):
         output_folder = self.node.outputs.retrieved
 
         fname = splitext(self.inputs.script.filename)[0]
@@ -74,8 +257,185 @@ class Script(CalcJob):
         if result is None:
             return self.exit_codes.ERROR_INVALID_OUTPUT
 
-        with output_folder.open(cname, 'r') as context_file:
-            self.out('context', Dict(dict=json.load(context_file)))
-            
+        if self.inputs['delta_context'].value:
+            with open(join(retrieved_temporary_folder, cname), 'r') as context_file:
+                context = json.load(context_file)
+            patch = context_patch(patched_context(self.inputs['context'], self.inputs.get('context_patches')), context)
+            if patch is not None:
+                self.out('context_patch', Dict(dict=patch))
+        else:
+            with output_folder.open(cname, 'r') as context_file:
+                self.out('context', Dict(dict=json.load(context_file)))
+
+        if self.inputs['retrieve_arrays'].value:
+            try:
+                arrays = parse_arrays(retrieved_temporary_folder, fname + '_results')
+            except (ValueError, zipfile.BadZipFile) as exc:
+                self.report(f'Could not read the array results: {exc}')
+                return self.exit_codes.ERROR_INVALID_ARRAYS
+            if arrays is not None:
+                self.out('arrays', arrays)
+
         return ExitCode(0)
 
+
+
+def validate_max_workers(value, ctx):
+    if value is not None and value.value < 1:
+        return 'max_workers should be at least 1.'
+
+
+class ScriptBatch(CalcJob):
+    """
+    Runs the same script for many parameter sets in a single job. Every entry of
+    the `parameters` namespace gets its own parameters, context and results files,
+    named after its key, and the script is ran once per entry, one after the other,
+    all at the same time if `parallel` is set, or at most `max_workers` at a time.
+    All entries start from the same `context`, and share the `files` and
+    `parent_folders` like for `Script`.
+
+    The entries are ran by a generated bash driver, `batch.sh`, through `xargs`,
+    which also records the exit code of the script for every entry. The driver
+    is started after the `prepend_text` and `append_text` options of the job.
+
+    The results files are parsed into the `results` namespace, array results
+    written like for `Script` into the `arrays` namespace, and the `status`
+    output maps every key to the exit status of its entry, so that failed entries
+    do not discard the results of the others. The exit codes of the script are
+    stored in the `returncodes` output.
+    """
+    @classmethod
+    def define(cls, spec: CalcJobProcessSpec):
+        super().define(spec)
+        spec.input('script',         valid_type=SinglefileData)
+        spec.input_namespace('parameters', valid_type=Dict, dynamic=True)
+        spec.input_namespace('parent_folders', valid_type=RemoteData, dynamic=True, required=False,
+                             help='Remote working directories made available in directories named after their key.')
+        spec.input('symlink_parents', valid_type=Bool, default=lambda: Bool(True),
+                   help='Symlink the parent folders rather than copying them.')
+        spec.inputs.validator = validate_parent_folders
+        spec.input('context',        valid_type=Dict, default=lambda: Dict())
+        spec.input('code',           valid_type=Code)
+        spec.input('cmdline_params', required=False)
+        spec.input_namespace('files', valid_type=(SinglefileData, FolderData), dynamic=True, required=False,
+                             help='Extra files copied next to the script, folders are copied into a directory named after their key.')
+        spec.input('parallel',       valid_type=Bool, default=lambda: Bool(False),
+                   help='Run the script for all parameter sets at the same time rather than one after the other.')
+        spec.input('max_workers',    valid_type=Int, required=False, validator=validate_max_workers,
+                   help='Run the script for at most this many parameter sets at the same time.')
+        spec.output_namespace('results', valid_type=Dict, dynamic=True)
+        spec.output_namespace('arrays', valid_type=ArrayData, dynamic=True)
+        spec.output('status',        valid_type=Dict)
+        spec.output('returncodes',   valid_type=Dict, help='The exit code of the script for every parameter set.')
+        spec.exit_code(300, 'ERROR_READING_OUTPUT_FILE', message='The results file could not be read.')
+        spec.exit_code(301, 'ERROR_INVALID_OUTPUT', message='The results file does not contain a json object.')
+        spec.exit_code(302, 'ERROR_ITEMS_FAILED', message='{failed} of {total} parameter sets failed.')
+        spec.exit_code(303, 'ERROR_INVALID_ARRAYS', message='The array results file could not be read.')
+        spec.exit_code(304, 'ERROR_SCRIPT_FAILED', message='The script exited with a non-zero exit code.')
+
+    @staticmethod
+    def filenames(key):
+        return f'{key}_parameters.json', f'{key}_context.json', f'{key}_results.json'
+
+    @property
+    def workers(self):
+        """The number of parameter sets that are ran at the same time."""
+        if 'max_workers' in self.inputs:
+            return self.inputs['max_workers'].value
+        return len(self.inputs['parameters']) if self.inputs['parallel'].value else 1
+
+    def prepare_for_submission(self, folder: Folder) -> CalcInfo:
+        context = json.dumps(self.inputs['context'].get_dict())
+        code = self.inputs.code
+        commands = []
+        retrieve_list = []
+        retrieve_temporary_list = []
+        for key, parameters in self.inputs['parameters'].items():
+            pname, cname, rname = self.filenames(key)
+            with folder.open(pname, 'w') as params_file:
+                json.dump(parameters.get_dict(), params_file)
+
+            with folder.open(cname, 'w') as context_file:
+                context_file.write(context)
+
+            cmdline_params = [self.inputs.script.filename, pname, cname, rname] + list(self.inputs.get('cmdline_params', []))
+            command = code.get_prepend_cmdline_params() + code.get_executable_cmdline_params(cmdline_params)
+            commands.append(
+                f"    {escape_for_bash(key)}) {' '.join(escape_for_bash(str(c)) for c in command)} "
+                f"> {escape_for_bash(key + '.out')} 2> {escape_for_bash(key + '.err')} ;;"
+            )
+            retrieve_list += [f'{key}.out', f'{key}.err', f'{key}.exit', rname]
+            retrieve_temporary_list += [f'{key}_results.npy', f'{key}_results.npz']
+
+        # Runs the script for the parameter set given as argument, and records its exit code
+        with folder.open('batch.sh', 'w') as driver:
+            driver.write('#!/bin/bash\ncase "$1" in\n' + '\n'.join(commands) + '\nesac\necho $? > "$1.exit"\n')
+        with folder.open('batch_keys.txt', 'w') as keys:
+            keys.write(''.join(f'{key}\n' for key in self.inputs['parameters']))
+
+        calcinfo = CalcInfo()
+        calcinfo.codes_info = []
+        calcinfo.append_text = f'xargs -P {max(self.workers, 1)} -n 1 bash batch.sh < batch_keys.txt'
+        calcinfo.local_copy_list = local_copy_list(self.inputs.script, self.inputs.get('files'))
+        calcinfo.remote_copy_list, calcinfo.remote_symlink_list = remote_copy_lists(self.inputs.get('parent_folders'), self.inputs['symlink_parents'].value)
+        calcinfo.retrieve_list = retrieve_list
+        calcinfo.retrieve_temporary_list = retrieve_temporary_list
+
+        return calcinfo
+
+    def parse(self, retrieved_temporary_folder=None, existing_exit_code=None):
+        # Overriding CalcJob.parse skips its removal of the temporary folder
+        try:
+            return self.parse_outputs(retrieved_temporary_folder)
+        finally:
+            if retrieved_temporary_folder is not None:
+                shutil.rmtree(retrieved_temporary_folder, ignore_errors=True)
+
+    def parse_outputs(self, retrieved_temporary_folder=None):
+        output_folder = self.node.outputs.retrieved
+
+        status = dict()
+        returncodes = dict()
+        for key in self.inputs['parameters']:
+            try:
+                with output_folder.open(f'{key}.exit', 'r') as handle:
+                    returncodes[key] = int(handle.read())
+            except (OSError, IOError, ValueError):
+                # The job stopped before the script for this parameter set finished
+                status[key] = self.exit_codes.ERROR_SCRIPT_FAILED.status
+                continue
+            if returncodes[key] != 0:
+                status[key] = self.exit_codes.ERROR_SCRIPT_FAILED.status
+                continue
+
+            rname = self.filenames(key)[2]
+            try:
+                with output_folder.open(rname, 'r') as handle:
+                    result = json.load(handle)
+            except (OSError, IOError, ValueError):
+                status[key] = self.exit_codes.ERROR_READING_OUTPUT_FILE.status
+                continue
+
+            if not isinstance(result, dict):
+                status[key] = self.exit_codes.ERROR_INVALID_OUTPUT.status
+                continue
+
+            if retrieved_temporary_folder is not None:
+                try:
+                    arrays = parse_arrays(retrieved_temporary_folder, f'{key}_results')
+                except (ValueError, zipfile.BadZipFile):
+                    status[key] = self.exit_codes.ERROR_INVALID_ARRAYS.status
+                    continue
+                if arrays is not None:
+                    self.out(f'arrays.{key}', arrays)
+
+            self.out(f'results.{key}', Dict(dict=result))
+            status[key] = 0
+
+        self.out('status', Dict(dict=status))
+        self.out('returncodes', Dict(dict=returncodes))
+
+        failed = sum(1 for s in status.values() if s != 0)
+        if failed:
+            return self.exit_codes.ERROR_ITEMS_FAILED.format(failed=failed, total=len(status))
+        return ExitCode(0)
@@ -0,0 +1,106 @@
+import json
+from collections import defaultdict
+from datetime import timedelta
+
+import click
+from tabulate import tabulate
+
+from aiida import load_profile, orm
+from aiida.common import timezone
+
+from .workflows.timings import TIMINGS_EXTRA
+from .batch import read_overrides, submit_batch
+
+
+@click.group('aiida-tools')
+@click.option('-p', '--profile', help='The AiiDA profile to use, the default profile if omitted.')
+def cli(profile):
+    """Command line tools of aiida-tools."""
+    load_profile(profile, allow_switch=True)
+
+
+def summarise_timings(rows):
+    """
+    Adds up the timings of many workchains, given as (process label, timings extra)
+    pairs, by chain, step and phase. Returns a list of dicts sorted by the total
+    time, largest first.
+    """
+    totals = defaultdict(lambda: [0, 0.0])
+    for process_label, timings in rows:
+        for step, phases in timings.get('steps', {}).items():
+            for phase, seconds in phases.items():
+                if phase == 'label':
+                    continue
+                entry = totals[(process_label, timings.get('label', ''), step, phases.get('label', ''), phase)]
+                entry[0] += 1
+                entry[1] += seconds
+
+    summary = [
+        {'process': k[0], 'chain': k[1], 'step': k[2], 'label': k[3], 'phase': k[4],
+         'count': count, 'total_seconds': total, 'mean_seconds': total / count}
+        for k, (count, total) in totals.items()
+    ]
+    return sorted(summary, key=lambda s: s['total_seconds'], reverse=True)
+
+
+@cli.command('timings')
+@click.option('-P', '--process-label', multiple=True, help='Only include workchains with this process label, e.g. DeclarativeChain.')
+@click.option('-d', '--past-days', type=int, help='Only include workchains created in the past PAST_DAYS days.')
+@click.option('-l', '--limit', type=int, help='Only include the LIMIT most recent workchains.')
+@click.option('-n', '--top', type=int, default=20, show_default=True, help='Show the TOP most expensive phases, all if 0.')
+@click.option('--json', 'as_json', is_flag=True, help='Print the summary as json.')
+def timings(process_label, past_days, limit, top, as_json):
+    """
+    Summarises the timings recorded by chains launched with `record_timings=True`,
+    by chain, step and phase.
+    """
+    filters = {'extras': {'has_key': TIMINGS_EXTRA}}
+    if process_label:
+        filters['attributes.process_label'] = {'in': list(process_label)}
+    if past_days is not None:
+        filters['ctime'] = {'>': timezone.now() - timedelta(days=past_days)}
+
+    qb = orm.QueryBuilder().append(
+        orm.WorkflowNode, filters=filters, project=['attributes.process_label', f'extras.{TIMINGS_EXTRA}']
+    ).order_by({orm.WorkflowNode: {'id': 'desc'}})
+    if limit is not None:
+        qb.limit(limit)
+
+    rows = qb.all()
+    summary = summarise_timings(rows)
+    if top:
+        summary = summary[:top]
+
+    if as_json:
+        click.echo(json.dumps({'processes': len(rows), 'timings': summary}, indent=2))
+        return
+
+    click.echo(f'Timings of {len(rows)} workchains.')
+    if summary:
+        click.echo(tabulate([list(s.values()) for s in summary], headers=list(summary[0].keys()), floatfmt='.4f'))
+
+
+@cli.command('submit')
+@click.argument('specification')
+@click.argument('overrides', type=click.Path(exists=True, dir_okay=False))
+@click.option('-m', '--max-active', type=int, default=100, show_default=True, help='Maximum number of chains of the batch running at the same time.')
+@click.option('-c', '--chunk-size', type=int, default=100, show_default=True, help='Number of overrides stored per transaction.')
+@click.option('-i', '--poll-interval', type=float, default=5.0, show_default=True, help='Seconds between checks for finished chains while MAX_ACTIVE are running.')
+@click.option('-G', '--group', help='Label of a group to add the chains to, created if it does not exist.')
+@click.option('--compact-checkpoints', is_flag=True, help='Launch the chains with `compact_checkpoints`.')
+def submit(specification, overrides, max_active, chunk_size, poll_interval, group, compact_checkpoints):
+    """
+    Submits a DeclarativeChain for every dict in the OVERRIDES file (json lines,
+    json or yaml), merged into the data of SPECIFICATION, a file or the pk of a
+    stored specification.
+    """
+    if specification.isdigit():
+        specification = orm.load_node(int(specification))
+    if group is not None:
+        group, _ = orm.Group.collection.get_or_create(label=group)
+
+    nodes = submit_batch(
+        specification, read_overrides(overrides), max_active=max_active, chunk_size=chunk_size,
+        poll_interval=poll_interval, group=group, compact_checkpoints=compact_checkpoints
+    )
+    click.echo(f'Submitted {len(nodes)} chains' + (f' to group {group.label}.' if group is not None else '.'))
@@ -1,24 +1,211 @@
+from collections import OrderedDict
 from pathlib import Path
+from threading import Lock
 from urllib.parse import urlsplit
+import hashlib
+import json
+import os
+import tempfile
+import time
 import cachecontrol
 import requests
 from ruamel.yaml import YAML
-import jsonref
 
 # Copied from https://github.com/aiidalab/aiidalab/blob/90b334e6a473393ba22b915fdaf85d917fd947f4/aiidalab/registry/yaml.py
 # licensed under the MIT license
 REQUESTS = cachecontrol.CacheControl(requests.Session())
 
-def my_fancy_loader(uri):
-    uri_split = urlsplit(uri)
-    if Path(uri_split.path).suffix in (".yml", ".yaml"):
+
+class RefCache:
+    """
+    Persistent, size limited cache of the raw documents referenced through `$ref`,
+    so that daemon workers do not fetch them again after a restart.
+
+    Each entry is stored as the raw content together with a small json file
+    holding its uri, sha256 and fetch time. Entries whose content does not match
+    their hash are discarded. Remote entries younger than `max_age` seconds are
+    used without contacting the server, older ones are refreshed and only used
+    if the server can not be reached. Local files are always read again, their
+    cached copy is only used when the file can not be read.
+
+    In `offline` mode nothing is fetched over the network and only cached
+    entries are used.
+
+    The defaults can be set through the `AIIDA_TOOLS_REF_CACHE_DIR`,
+    `AIIDA_TOOLS_REF_CACHE_SIZE` (bytes), `AIIDA_TOOLS_REF_CACHE_MAX_AGE`
+    (seconds) and `AIIDA_TOOLS_OFFLINE` environment variables.
+    """
+    def __init__(self, directory=None, max_size=None, max_age=None, offline=None):
+        env = os.environ
+        self.directory = Path(directory or env.get('AIIDA_TOOLS_REF_CACHE_DIR', Path.home() / '.cache' / 'aiida-tools' / 'refs'))
+        self.max_size = int(max_size if max_size is not None else env.get('AIIDA_TOOLS_REF_CACHE_SIZE', 100 * 2**20))
+        self.max_age = float(max_age if max_age is not None else env.get('AIIDA_TOOLS_REF_CACHE_MAX_AGE', 24 * 3600))
+        if offline is None:
+            offline = env.get('AIIDA_TOOLS_OFFLINE', '').lower() not in ('', '0', 'false')
+        self.offline = offline
+        # (uri, sha256 of the content) -> parsed document
+        self.documents = LRUCache(maxsize=256)
+
+    def _paths(self, uri):
+        key = hashlib.sha256(uri.encode()).hexdigest()
+        return self.directory / f'{key}.data', self.directory / f'{key}.json'
+
+    def read(self, uri):
+        """Returns the cached (content, metadata) of `uri`, or None."""
+        data_path, meta_path = self._paths(uri)
+        try:
+            meta = json.loads(meta_path.read_text())
+            content = data_path.read_bytes()
+        except (OSError, ValueError):
+            return None
+
+        if meta.get('uri') != uri or hashlib.sha256(content).hexdigest() != meta.get('sha256'):
+            self.remove(uri)
+            return None
+
+        # Marks the entry as recently used
+        os.utime(meta_path)
+        return content, meta
+
+    def write(self, uri, content):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        data_path, meta_path = self._paths(uri)
+        meta = {'uri': uri, 'sha256': hashlib.sha256(content).hexdigest(), 'fetched': time.time()}
+        # Write to temporary files first, so that concurrent workers never see partial entries.
+        for path, data in ((data_path, content), (meta_path, json.dumps(meta).encode())):
+            fd, tmp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        self.evict()
+
+    def remove(self, uri):
+        for path in self._paths(uri):
+            path.unlink(missing_ok=True)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in `max_size`."""
+        entries = []
+        for meta_path in self.directory.glob('*.json'):
+            data_path = meta_path.with_suffix('.data')
+            try:
+                entries.append((meta_path.stat().st_mtime, data_path.stat().st_size, meta_path, data_path))
+            except OSError:
+                continue
+
+        total = sum(e[1] for e in entries)
+        for _, size, meta_path, data_path in sorted(entries):
+            if total <= self.max_size:
+                break
+            meta_path.unlink(missing_ok=True)
+            data_path.unlink(missing_ok=True)
+            total -= size
+
+    def get(self, uri):
+        """Returns the raw content of `uri`, from the cache if possible."""
+        uri_split = urlsplit(uri)
+        cached = self.read(uri)
+
         if uri_split.scheme == "file":
-            content = Path(uri_split.path).read_bytes()
-        else:
+            try:
+                content = Path(uri_split.path).read_bytes()
+            except OSError:
+                if cached is None:
+                    raise
+                return cached[0]
+            if cached is None or hashlib.sha256(content).hexdigest() != cached[1]['sha256']:
+                self.write(uri, content)
+            return content
+
+        if cached is not None and (self.offline or time.time() - cached[1]['fetched'] < self.max_age):
+            return cached[0]
+
+        if self.offline:
+            raise LookupError(f'{uri} is not in the reference cache at {self.directory} and offline mode is enabled.')
+
+        try:
             response = REQUESTS.get(uri)
             response.raise_for_status()
-            content = response.content
-        return YAML(typ="safe").load(content)
-    else:
-        return jsonref.load_uri(uri, **kwargs)
+        except requests.RequestException:
+            if cached is None:
+                raise
+            return cached[0]
+
+        self.write(uri, response.content)
+        return response.content
+
+    def load(self, uri):
+        """Returns the parsed document at `uri`. Each distinct content is only parsed once."""
+        content = self.get(uri)
+
+        def parse():
+            if Path(urlsplit(uri).path).suffix in (".yml", ".yaml"):
+                return YAML(typ="safe").load(content)
+            else:
+                return json.loads(content)
+
+        return self.documents.get_or_create((uri, hashlib.sha256(content).hexdigest()), parse)
+
+
+def my_fancy_loader(uri):
+    """Loader for jsonref that also understands yaml, going through the persistent `REF_CACHE`."""
+    return REF_CACHE.load(uri)
+
+
+_MISSING = object()
+
+
+class LRUCache:
+    """
+    A small thread-safe least-recently-used cache with hit/miss counters.
+
+    Instances are meant to live at module or class level, so that whatever
+    they hold is shared by all processes running inside the same daemon worker.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def get_or_create(self, key, factory):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = self.put(key, factory())
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._data), 'maxsize': self.maxsize}
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
 
+REF_CACHE = RefCache()
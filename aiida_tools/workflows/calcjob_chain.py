@@ -1,13 +1,67 @@
-from aiida.orm import Dict, SinglefileData, Str
-from aiida.engine import WorkChain, ToContext, while_, calcfunction, CalcJob
+from aiida.orm import Str
+from aiida.engine import ToContext, while_
+from aiida.engine.utils import is_process_function
 from aiida.plugins import CalculationFactory
-
-class CalcJobChain(WorkChain):
+from aiida.common.links import LinkType
+from ..utils import LRUCache
+from .timings import TimedWorkChain
+
+
+def process_spec(process):
+    """The spec of a process class or process function."""
+    return process.process_class.spec() if is_process_function(process) else process.spec()
+
+
+class WiringPlan:
+    """
+    Which outputs of each step of a chain are passed as inputs to the next one.
+    A required input of a step that is not given explicitly is taken from the
+    output with the same name of the previous step. `links[i]` holds the
+    (output, input) pairs feeding step `i`, and `errors` the required inputs
+    that can not be provided at all.
+    """
+    def __init__(self, names, given):
+        processes = [CalculationFactory(name) for name in names]
+        self.links = []
+        self.errors = []
+        for i, (name, process) in enumerate(zip(names, processes)):
+            links = []
+            if i > 0:
+                outputs = process_spec(processes[i - 1]).outputs
+            for k, port in process_spec(process).inputs.items():
+                if not port.required or getattr(port, 'is_metadata', False) or k in given[i]:
+                    continue
+                if i > 0 and (k in outputs or outputs.dynamic):
+                    links.append((k, k))
+                elif i > 0:
+                    self.errors.append(f'the required input `{k}` of step {i} ({name}) is neither given nor an output of step {i - 1} ({names[i - 1]}).')
+                else:
+                    self.errors.append(f'the required input `{k}` of step 0 ({name}) is not given.')
+            self.links.append(links)
+
+
+# Plans keyed by the entry points of the steps and the names of their given inputs.
+wiring_plans = LRUCache(maxsize=128)
+
+
+def wiring_plan(names, given):
+    names, given = tuple(names), tuple(frozenset(g) for g in given)
+    return wiring_plans.get_or_create((names, given), lambda: WiringPlan(names, given))
+
+
+class CalcJobChain(TimedWorkChain):
+    """
+    Runs a series of calculations, given as entry point names in `calcjobs`
+    with keys `0`, `1`, ..., with the inputs of the same key in `inputs`.
+    Required inputs of a calculation that are not given are taken from the
+    outputs with the same name of the previous one. The outputs of each
+    calculation are returned in `results` under its key.
+    """
 
     @classmethod
     def define(cls, spec):
         super().define(spec)
-        spec.input_namespace('calcjobs', dynamic=True)
+        spec.input_namespace('calcjobs', dynamic=True, valid_type=Str)
         spec.input_namespace('inputs', dynamic=True)
         spec.input_namespace('preprocess', dynamic=True, required=False,valid_type=Str)
         spec.input_namespace('postprocess', dynamic=True, required=False, valid_type=Str)
@@ -19,98 +73,80 @@ class CalcJobChain(WorkChain):
                 cls.submit_next,
                 cls.process_current
             ),
-            cls.finalize
         )
         spec.output_namespace('results', dynamic=True)
+        spec.exit_code(2, 'ERROR_SUBPROCESS', message='Step {step} failed.')
+        spec.exit_code(3, 'ERROR_MISSING_OUTPUT', message='Step {step} did not return the output `{output}` needed by the next step.')
 
     @classmethod
     def check_inputs(self, inputs, _):
         cjobs = inputs['calcjobs']
-        inputs = inputs['inputs']
+        ins = inputs['inputs']
 
-        if len(cjobs) != len(inputs):
+        if len(cjobs) != len(ins):
             return 'ERROR: amount of calcjobs and inputs are not equal.'
 
         for k in cjobs.keys():
-            if k not in inputs:
+            if k not in ins:
                 return f'ERROR: key {k} not found in inputs.'
 
-        calcjobs = list(map(lambda x: CalculationFactory(cjobs[f'{x}'].value) if isinstance(cjobs[f'{x}'], Str) else cjobs[f'{x}'], range(0, len(cjobs))))
-        inputs   = list(map(lambda x: inputs[f'{x}'], range(0, len(cjobs))))
+        if set(cjobs.keys()) != {f'{i}' for i in range(len(cjobs))}:
+            return 'ERROR: the keys of calcjobs should be 0, 1, 2, ...'
+
+        try:
+            plan = wiring_plan(*self.wiring_keys(inputs))
+        except Exception as e:
+            return f'ERROR: {e}'
 
-        for i in range(0, len(calcjobs)):
-            if i == 0:
-                provided_ins = inputs[i].keys()
-            else:
-                if isinstance(calcjobs[i-1], CalcJob):
-                    provided_ins = calcjobs[i-1].spec().outputs
-                elif isinstance(calcjobs[i-1], flows.data.PyFunction):
-                    provided_ins = calcjobs[i-1].returns
+        if plan.errors:
+            return f'ERROR: {plan.errors[0]}'
 
-                if isinstance(calcjobs[i], CalcJob):
-                    provided_ins += inputs[i].keys() 
-                elif isinstance(calcjobs[i], flows.data.PyFunction):
-                    provided_ins += inputs[i]['parameters'].keys()
+    @staticmethod
+    def wiring_keys(inputs):
+        """The entry points of the steps and the names of their given inputs, in order."""
+        n = len(inputs['calcjobs'])
+        names = [inputs['calcjobs'][f'{i}'].value for i in range(n)]
+        given = [inputs['inputs'][f'{i}'].keys() for i in range(n)]
+        return names, given
 
     def setup(self):
         self.ctx.current_id = 0
-        self.ctx.results    = dict()
-        n = len(self.inputs['calcjobs'])
-        self.ctx.calcjobs = list(map(lambda x: CalculationFactory(self.inputs['calcjobs'][f'{x}'].value) if isinstance(self.inputs['calcjobs'][f'{x}'], Str) else self.inputs['calcjobs'][f'{x}'], range(0, n)))
-        self.ctx.inputs = list(map(lambda x: self.inputs['inputs'][f'{x}'], range(0, n)))
-        
+        names, given = self.wiring_keys(self.inputs)
+        self.ctx.calcjobs = names
+        self.ctx.wiring = wiring_plan(names, given).links
+        self.label_timings(' > '.join(names))
+
     def not_finished(self):
-        return self.ctx.current_id < len(self.ctx.calcjobs) 
+        return self.ctx.current_id < len(self.ctx.calcjobs)
 
     def submit_next(self):
-        id     = self.ctx.current_id
-        inputs = self.ctx.inputs[id]
-        cjob   = self.ctx.calcjobs[id]
-
-        if isinstance(cjob, flows.data.PyFunction):
-            return ToContext(current = self.submit(flows.engine.apply(cjob, **inputs['parameters']).on(inputs['environment'])))
-        else:
-            return ToContext(current = self.submit(cjob, **inputs))
-        
+        step = self.ctx.current_id
+        self.label_timings(self.ctx.calcjobs[step], step)
+        with self.timed(step, 'wiring'):
+            inputs = dict(self.inputs['inputs'][f'{step}'])
+            for output, input in self.ctx.wiring[step]:
+                # ctx.current is still the process of the previous step
+                if output not in self.ctx.current.outputs:
+                    return self.exit_codes.ERROR_MISSING_OUTPUT.format(step=step - 1, output=output)
+                inputs[input] = self.ctx.current.outputs[output]
+                self.logger.debug(f'Passing output `{output}` of step {step - 1} as input `{input}` of step {step}.')
+
+        with self.timed(step, 'submit'):
+            cjob = CalculationFactory(self.ctx.calcjobs[step])
+            if is_process_function(cjob):
+                cjob = cjob.process_class
+            node = self.submit(cjob, **inputs)
+
+        self.start_waiting(step)
+        return ToContext(current=node)
 
     def process_current(self):
-        results = dict()
-        outputs = self.ctx.current.outputs.return_values if isinstance(self.ctx.calcjobs[self.ctx.current_id], flows.data.PyFunction) else self.ctx.current.outputs
-        for k in outputs:
-            results[k] = outputs[k]
-
-        self.ctx.results[k] = results
+        self.stop_waiting()
+        step = self.ctx.current_id
+        node = self.ctx.current
+        if not node.is_finished_ok:
+            self.report(f'Step {step} failed with exit status {node.exit_status}: {node.exit_message}')
+            return self.exit_codes.ERROR_SUBPROCESS.format(step=step)
+
+        self.out(f'results.{step}', node.base.links.get_outgoing(link_type=(LinkType.CREATE, LinkType.RETURN)).nested())
         self.ctx.current_id += 1
-        if self.not_finished():
-            next = self.ctx.calcjobs[self.ctx.current_id]
-
-            if isinstance(next, flows.data.PyFunction):
-                inputs = self.ctx.inputs[self.ctx.current_id]['parameters']
-                req_inputs = self.ctx.calcjobs[self.ctx.current_id].parameters
-            else:
-                inputs = self.ctx.inputs[self.ctx.current_id]
-                tins = self.ctx.calcjobs[self.ctx.current_id].spec().inputs
-                req_inputs = list(filter(lambda x: tins[x].required, tins))
-            print("##########################################################")
-            print(list(req_inputs))
-            print("##########################################################")
-            print("##########################################################")
-            print(list(outputs))
-            print("##########################################################")
-            print("##########################################################")
-            print(list(inputs))
-            print("##########################################################")
-            for k in outputs:
-                if k not in inputs and k in req_inputs:
-                    print("##########################################################")
-                    print(outputs[k])
-                    print("##########################################################")
-                    t = outputs[k]
-                    if isinstance(t, flows.data.PyRemoteData):
-                        inputs[k] = outputs.return_values[k].fetch_value()
-                    else:
-                        inputs[k] = t
-
-    def finalize(self):
-        self.out('results', self.ctx.results)
-    
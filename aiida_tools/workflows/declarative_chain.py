@@ -1,19 +1,29 @@
 from aiida import orm
 from jinja2.nativetypes import NativeEnvironment
-from jinja2 import Environment
-from aiida.orm import Dict, SinglefileData, Str, load_node, load_code, load_group, Int, Float, List
-from aiida.engine import WorkChain, ToContext, while_, calcfunction, run_get_node, ExitCode
+from jinja2 import Environment, pass_context
+from aiida.orm import Dict, SinglefileData, Str, load_node, load_code, Int, Float, List
+from aiida.engine import ToContext, while_, calcfunction, run_get_node, ExitCode
 from aiida.plugins import CalculationFactory, DataFactory, WorkflowFactory
 from aiida.engine.utils import is_process_function
+from aiida.common.links import LinkType
+from aiida.common.exceptions import NotExistent
 from jsonschema import validate
 import json
 import sys
+import copy
+import hashlib
+import time
 import plumpy
+import numpy as np
 from aiida_pseudo.data.pseudo.upf import UpfData
 import jsonref
 from os.path import splitext
+from types import MappingProxyType
+from collections.abc import Mapping
 from ruamel.yaml import YAML
-from ..utils import my_fancy_loader
+from ..utils import my_fancy_loader, LRUCache
+from .scheduling import schedule_steps, compile_program, early_results
+from .timings import TimedWorkChain
 
 # from jinja2.nativetypes import NativeEnvironment
 
@@ -29,6 +39,21 @@ schema = {
                 "$ref": "#/definitions/Step"
             },
             "minItems": 1
+        },
+        "schedule": {
+            "type": "string",
+            "enum": ["sequential", "dag"]
+        },
+        "max_concurrent": {
+            "type": "integer",
+            "minimum": 1
+        },
+        "deduplicate": {
+            "type": "boolean"
+        },
+        "process_functions": {
+            "type": "string",
+            "enum": ["inline", "submit"]
         }
     },
     "required": ["steps"],
@@ -63,15 +88,78 @@ schema = {
                 "steps": {
                     "type": "array"
                 },
+                "parallel": {
+                    "type": "array",
+                    "items": {
+                        "$ref": "#/definitions/Step"
+                    }
+                },
+                "map": {
+                    "type": "string"
+                },
+                "as": {
+                    "type": "string"
+                },
+                "max_in_flight": {
+                    "type": "integer",
+                    "minimum": 1
+                },
+                "step": {
+                    "$ref": "#/definitions/Step"
+                },
+                "results": {
+                    "type": "string"
+                },
+                "output": {
+                    "type": "string"
+                },
                 "node": {
                     "type": "integer"
                 },
                 "error": {
                     "type": "object"
+                },
+                "cache": {
+                    "type": "boolean"
+                },
+                "retry": {
+                    "$ref": "#/definitions/Retry"
                 }
             },
             "additionalProperties": False,
             "title": "Step"
+        },
+        "Retry": {
+            "type": "object",
+            "properties": {
+                "max_attempts": {
+                    "type": "integer",
+                    "minimum": 1
+                },
+                "exit_codes": {
+                    "type": "array",
+                    "items": {
+                        "type": "integer"
+                    }
+                },
+                "backoff": {
+                    "type": "number",
+                    "minimum": 0
+                },
+                "factor": {
+                    "type": "number",
+                    "minimum": 1
+                },
+                "max_backoff": {
+                    "type": "number",
+                    "minimum": 0
+                },
+                "inputs": {
+                    "type": "object"
+                }
+            },
+            "additionalProperties": False,
+            "title": "Retry"
         }
     }
 }
@@ -168,22 +256,119 @@ upfschema = {
 }
 
 
-def dict2structure(d):
-    validate(instance=d, schema=structschema)
-    structure = DataFactory('core.structure')(cell=d['cell'])
-    for a in d['atoms']:
-        structure.append_atom(**a)
+# Above this amount of atoms, structures are validated with `validate_structure_arrays`
+# rather than with the json schema.
+SCHEMA_VALIDATION_MAX_ATOMS = 100
+
+
+def validate_structure_arrays(cell, symbols, positions):
+    """Fast validation of a structure given as arrays, raises a ValueError if it is invalid."""
+    if cell.shape != (3, 3) or not np.isfinite(cell).all():
+        raise ValueError(f'The cell of a structure should be a 3x3 array of numbers, got shape {cell.shape}.')
+    if positions.ndim != 2 or positions.shape[1] != 3 or positions.shape[0] < 1:
+        raise ValueError(f'The positions of a structure should be a non-empty Nx3 array, got shape {positions.shape}.')
+    if not np.isfinite(positions).all():
+        raise ValueError('The positions of a structure should be finite numbers.')
+    if symbols.shape != (positions.shape[0],):
+        raise ValueError(f'Got {symbols.size} symbols for {positions.shape[0]} positions.')
+
+
+def arrays2structure(cell, symbols, positions):
+    """
+    Builds a StructureData from a 3x3 cell, N symbols and Nx3 positions.
+    Kinds are created once per unique symbol and all sites are set at once,
+    instead of checking the kinds and positions again for each atom.
+    """
+    cell = np.asarray(cell, dtype=float)
+    symbols = np.asarray(symbols, dtype=str)
+    positions = np.asarray(positions, dtype=float)
+    validate_structure_arrays(cell, symbols, positions)
+
+    structure = DataFactory('core.structure')(cell=cell.tolist())
+    for symbol in dict.fromkeys(symbols.tolist()):
+        structure.append_kind(orm.Kind(symbols=symbol, name=symbol))
+
+    structure.base.attributes.set('sites', [
+        {'position': tuple(p), 'kind_name': s} for s, p in zip(symbols.tolist(), positions.tolist())
+    ])
     return structure
 
 
+def dict2structure(d):
+    """
+    Builds a StructureData from either a list of `atoms`, each with `symbols`
+    and `position`, or from `symbols` and `positions` arrays.
+    """
+    if 'atoms' not in d:
+        return arrays2structure(d['cell'], d['symbols'], d['positions'])
+
+    atoms = d['atoms']
+    if len(atoms) <= SCHEMA_VALIDATION_MAX_ATOMS:
+        validate(instance=d, schema=structschema)
+
+    # Atoms with more than a symbol and a position need the full append_atom treatment
+    if any(len(a) != 2 for a in atoms):
+        structure = DataFactory('core.structure')(cell=d['cell'])
+        for a in atoms:
+            structure.append_atom(**a)
+        return structure
+
+    try:
+        symbols = [a['symbols'] for a in atoms]
+        positions = [a['position'] for a in atoms]
+    except KeyError as exc:
+        raise ValueError(f'Every atom of a structure needs {exc.args[0]}.') from exc
+    return arrays2structure(d['cell'], symbols, positions)
+
+
 def dict2code(d):
     return load_code(d)
 
 
-def dict2upf(d):
+class PseudoResolver:
+    """
+    Looks up pseudopotentials in pseudopotential families and caches them by
+    (family label, element). All the elements that are requested together
+    from a family are fetched with a single query.
+    """
+    def __init__(self):
+        self.cache = dict()
+
+    def prefetch(self, group, elements):
+        missing = [e for e in set(elements) if (group, e) not in self.cache]
+        if not missing:
+            return
+
+        qb = orm.QueryBuilder()
+        qb.append(orm.Group, filters={'label': group}, tag='group')
+        qb.append(orm.Data, with_group='group', filters={'attributes.element': {'in': missing}}, project=['attributes.element', '*'])
+        for element, pseudo in qb.iterall():
+            self.cache[(group, element)] = pseudo
+
+    def prefetch_all(self, specs):
+        """Prefetches the pseudopotentials for a collection of `{group, element}` dicts."""
+        groups = dict()
+        for d in specs:
+            groups.setdefault(d['group'], []).append(d['element'])
+        for group, elements in groups.items():
+            self.prefetch(group, elements)
+
+    def get(self, group, element):
+        self.prefetch(group, [element])
+        if (group, element) not in self.cache:
+            raise ValueError(f'No pseudopotential for element {element} found in family {group}.')
+        return self.cache[(group, element)]
+
+
+def is_upf_type(typ):
+    return typ is UpfData or typ is orm.nodes.data.upf.UpfData
+
+
+def dict2upf(d, pseudos=None):
     validate(instance=d, schema=upfschema)
-    group = load_group(d['group'])
-    return group.get_pseudo(element=d['element'])
+    if pseudos is None:
+        pseudos = PseudoResolver()
+    return pseudos.get(d['group'], d['element'])
 
 
 #TODO: implement for old upfs?
@@ -200,41 +385,376 @@ def dict2kpoints(d):
     return kpoints
 
 
-def dict2datanode(dat, typ, dynamic=False):
-    # Resolve recursively
-    if dynamic:
-        out = dict()
-        for k in dat:
-            # Is there only 1 level of dynamisism?
-            out[k] = dict2datanode(dat[k], typ, False)
-        return out
+def data_types(typ):
+    """The Data subclasses in a port's valid_type, which can be a single type, a tuple or None."""
+    types = typ if isinstance(typ, tuple) else (typ,)
+    return tuple(t for t in types if isinstance(t, type) and issubclass(t, orm.Data))
 
-    # If node is specified, just load node
-    if dat is dict and "node" in dat:
-        return load_node(dat["node"])
 
-    # More than one typ possible
-    if isinstance(typ, tuple):
-        for t in typ:
-            try:
-                return dict2datanode(dat, t, dynamic)
-            except:
-                None
-    # Else resolve DataNode from value
-    if typ is orm.AbstractCode:
-        return dict2code(dat)
+def convert_generic(val, pseudos=None):
+    if isinstance(val, orm.Data):
+        return val
+    return orm.to_aiida_type(val)
+
+
+def convert_type(typ):
+    """Returns a function `(value, pseudos) -> node` that builds a node of type `typ` from a raw value."""
+    if issubclass(typ, orm.AbstractCode):
+        return lambda val, pseudos=None: dict2code(val)
     elif typ is orm.StructureData:
-        return dict2structure(dat)
-    elif typ is UpfData or typ is orm.nodes.data.upf.UpfData:
-        return dict2upf(dat)
+        return lambda val, pseudos=None: dict2structure(val)
+    elif is_upf_type(typ):
+        return dict2upf
     elif typ is orm.KpointsData:
-        return dict2kpoints(dat)
+        return lambda val, pseudos=None: dict2kpoints(val)
     elif typ is Dict:
-        return Dict(dict=dat)
+        return lambda val, pseudos=None: Dict(dict=val)
     elif typ is List:
-        return List(list=dat)
+        return lambda val, pseudos=None: List(list=val)
+    elif typ in (orm.Data, orm.BaseType, orm.NumericType):
+        # Base classes can not be constructed from a value, let aiida pick the type
+        return convert_generic
+    else:
+        return lambda val, pseudos=None: typ(val)
+
+
+def convert_types(types):
+    """
+    Returns a function that converts a raw value into a node of one of `types`.
+    With more than one candidate, the node aiida would create for the value
+    is used if it is one of them, otherwise the value is built as the first one.
+    """
+    if not types:
+        return convert_generic
+    elif len(types) == 1:
+        return convert_type(types[0])
+
+    first = convert_type(types[0])
+
+    def convert(val, pseudos=None):
+        try:
+            node = orm.to_aiida_type(val)
+        except TypeError:
+            node = None
+        if isinstance(node, types):
+            return node
+        return first(val, pseudos)
+
+    return convert
+
+
+def checked_converter(types, label):
+    """
+    Wraps the converter for `types` so that values that already have the right
+    type are passed through and failed conversions report which input they were for.
+    """
+    convert = convert_types(types)
+    names = ' or '.join(t.__name__ for t in types) or 'Data'
+
+    def checked(val, pseudos=None):
+        if isinstance(val, types or orm.Data):
+            return val
+        # If node is specified, just load node
+        if isinstance(val, dict) and list(val) == ['node']:
+            return load_node(val['node'])
+        if isinstance(val, orm.Data):
+            raise TypeError(f'Input `{label}` should be a {names}, got a {type(val).__name__} node.')
+        try:
+            node = convert(val, pseudos)
+        except Exception as exc:
+            raise ValueError(f'Could not convert the value of input `{label}` (a {type(val).__name__}) into a {names}: {exc}') from exc
+        if types and not isinstance(node, types):
+            raise TypeError(f'Input `{label}` should be a {names}, got a {type(node).__name__} from a {type(val).__name__}.')
+        return node
+
+    return checked
+
+
+def prefetch_pseudos(values, pseudos):
+    """Fetches the pseudopotentials for all the `{group, element}` dicts in `values` at once."""
+    specs = [d for d in values if not isinstance(d, orm.Data)]
+    for d in specs:
+        validate(instance=d, schema=upfschema)
+    pseudos.prefetch_all(specs)
+
+
+def passthrough(val, pseudos=None):
+    return val
+
+
+class InputPlan:
+    """
+    How to build the inputs of a process from the raw values in a step.
+
+    Every port of the process, including those in nested namespaces, is resolved
+    once to a converter `(value, pseudos) -> node`. Keys of step inputs are split
+    into the path of a port and the path of an entry inside the value of that
+    port, e.g. `parameters.CONTROL.calculation` is the entry `CONTROL.calculation`
+    of the `parameters` port.
+    """
+    def __init__(self, process):
+        self.name = process.__name__
+        self.converters = dict()
+        self.namespaces = dict()
+        self.add_namespace((), process.spec().inputs, False)
+
+    def add_namespace(self, path, namespace, raw):
+        self.namespaces[path] = namespace
+        raw = raw or namespace.is_metadata or namespace.non_db
+        if namespace.dynamic:
+            self.converters[path + ('*',)] = self.leaf_converter(path + ('*',), namespace.valid_type, raw)
+        for k, port in namespace.items():
+            if isinstance(port, plumpy.PortNamespace):
+                self.add_namespace(path + (k,), port, raw)
+            else:
+                self.converters[path + (k,)] = self.leaf_converter(path + (k,), port.valid_type, raw or port.is_metadata or port.non_db)
+
+    def leaf_converter(self, path, valid_type, raw):
+        types = data_types(valid_type)
+        # Metadata and other ports that do not take nodes are passed as is
+        if raw or (valid_type is not None and not types):
+            return passthrough
+        return checked_converter(types, self.label(path))
+
+    def label(self, path):
+        return '.'.join((self.name,) + tuple(path))
+
+    def split(self, key):
+        """Splits a dotted key into the path of a port and the path inside its value."""
+        parts = tuple(key.split('.'))
+        path = ()
+        for i, part in enumerate(parts):
+            namespace = self.namespaces.get(path)
+            if namespace is None:
+                # path is a port, the rest is inside its value
+                return path, parts[i:]
+            if part not in namespace and not namespace.dynamic:
+                raise ValueError(f'`{key}` is not an input of {self.name}.')
+            path = path + (part,)
+        return path, ()
+
+    def converter(self, path):
+        if path in self.converters:
+            return self.converters[path]
+        # Entry of a dynamic namespace
+        return self.converters[path[:-1] + ('*',)]
+
+    def convert(self, path, val, pseudos=None, typ=None):
+        """
+        Converts the raw value of the port (or namespace) at `path`. An explicit
+        `typ` is used instead of the valid type of the port, or of every entry
+        of the namespace.
+        """
+        namespace = self.namespaces.get(path)
+        if namespace is None:
+            if typ is not None:
+                return checked_converter((typ,), self.label(path))(val, pseudos)
+            return self.converter(path)(val, pseudos)
+
+        if namespace.is_metadata or namespace.non_db:
+            return val
+        if not isinstance(val, dict):
+            raise TypeError(f'Input namespace `{self.label(path)}` should be given a dictionary, got a {type(val).__name__}.')
+
+        # Fetch all the pseudos of a namespace at once
+        types = (typ,) if typ is not None else data_types(namespace.valid_type)
+        if namespace.dynamic and pseudos is not None and any(is_upf_type(t) for t in types):
+            prefetch_pseudos([v for k, v in val.items() if k not in namespace], pseudos)
+
+        out = dict()
+        for k, v in val.items():
+            if k not in namespace and not namespace.dynamic:
+                raise ValueError(f'`{k}` is not an input of {self.label(path)}.')
+            out[k] = self.convert(path + (k,), v, pseudos, typ)
+        return out
+
+    def raw_values(self, step_inputs, render):
+        """
+        Returns the raw values and explicit types by port of the `step_inputs`
+        of a step, with their templates rendered by `render`. Entries set inside
+        the value of a port (e.g. `parameters.CONTROL.calculation`) are applied
+        to a copy of it. The `step_inputs` themselves are never modified.
+        """
+        values, types, entries = dict(), dict(), []
+        for k in step_inputs:
+            # A copy, as values of namespaces like `metadata` are not converted
+            # and the inputs given separately are then set inside them
+            d = thaw(step_inputs[k])
+            typ = None
+            if isinstance(d, dict) and 'type' in d:
+                typ = DataFactory(d['type'])
+                val = d['value'] if 'value' in d else {dk: dv for dk, dv in d.items() if dk != 'type'}
+            else:
+                val = d
+
+            if isinstance(val, str):
+                val = render(val)
+
+            path, entry = self.split(k)
+            if entry:
+                entries.append((path, entry, val))
+            else:
+                values[path] = val
+                types[path] = typ
+
+        for path, entry, val in entries:
+            base = values.get(path, dict())
+            if isinstance(base, orm.Dict):
+                base = base.get_dict()
+            elif isinstance(base, dict):
+                base = copy.deepcopy(base)
+            else:
+                raise TypeError(f"Can not set `{'.'.join(entry)}` in the value of input `{self.label(path)}`, which is a {type(base).__name__}.")
+            set_dot2index(base, list(entry), val)
+            values[path] = base
+        return values, types
+
+    def inputs(self, values, types=None, pseudos=None):
+        """Converts the raw `values` by port into the nested inputs of the process."""
+        inputs = dict()
+        # Namespaces first, so that values of their ports given separately are set inside them
+        for path in sorted(values, key=len):
+            set_dot2index(inputs, list(path), self.convert(path, values[path], pseudos, (types or {}).get(path)))
+        return inputs
+
+
+# Input plans of process classes, shared by all chains in the same interpreter.
+input_plans = LRUCache(maxsize=128)
+
+
+def input_plan(process):
+    return input_plans.get_or_create(process, lambda: InputPlan(process))
+
+
+def dict2datanode(dat, typ, dynamic=False, pseudos=None):
+    """Converts `dat` into a node of type `typ`, or a dict of nodes if `dynamic`."""
+    convert = checked_converter(data_types(typ), 'value')
+    if not dynamic:
+        return convert(dat, pseudos)
+
+    if pseudos is not None and is_upf_type(typ):
+        prefetch_pseudos(dat.values(), pseudos)
+    return {k: convert(v, pseudos) for k, v in dat.items()}
+
+
+# Node types that are reused when a stored node with the same content already exists.
+DEDUPLICATED_TYPES = (orm.Dict, orm.List, orm.KpointsData, orm.StructureData)
+
+# Content hash -> pk of stored nodes, shared by all chains in the same interpreter.
+node_index = LRUCache(maxsize=4096)
+
+
+def deduplicate(node):
+    """
+    Returns an already stored node with the same content hash as the unstored
+    `node`. If there is none, `node` is stored so that it can be reused later on.
+    """
+    if node.is_stored or not isinstance(node, DEDUPLICATED_TYPES):
+        return node
+
+    h = node.base.caching._compute_hash()
+    if h is None:
+        return node
+
+    pk = node_index.get(h)
+    if pk is not None:
+        try:
+            return load_node(pk)
+        except NotExistent:
+            pass
+
+    existing = orm.QueryBuilder().append(orm.Data, filters={'extras._aiida_hash': h}, project='id').first()
+    if existing is not None:
+        node_index.put(h, existing[0])
+        return load_node(existing[0])
+
+    node_index.put(h, node.store().pk)
+    return node
+
+
+def deduplicate_inputs(inputs):
+    """Applies `deduplicate` to all the nodes in a (nested) dict of inputs."""
+    if isinstance(inputs, dict):
+        return {k: deduplicate_inputs(v) for k, v in inputs.items()}
+    elif isinstance(inputs, orm.Data):
+        return deduplicate(inputs)
+    else:
+        return inputs
+
+
+# Extra holding the hash of the process type and inputs of processes launched by cached steps.
+STEP_HASH_EXTRA = 'aiida_tools_step_hash'
+
+
+def canonical_inputs(inputs):
+    """
+    The (nested) dict of inputs in a form that can be dumped to json, with nodes
+    replaced by their content hash and metadata left out. Returns None if a
+    node can not be hashed.
+    """
+    if isinstance(inputs, dict):
+        items = {k: canonical_inputs(v) for k, v in inputs.items() if k != 'metadata'}
+        return None if any(v is None for v in items.values()) else items
+    elif isinstance(inputs, (list, tuple)):
+        items = [canonical_inputs(v) for v in inputs]
+        return None if any(v is None for v in items) else items
+    elif isinstance(inputs, orm.Node):
+        h = inputs.base.caching.get_hash() if inputs.is_stored else inputs.base.caching._compute_hash()
+        return None if h is None else {'node': h}
     else:
-        return typ(dat)
+        return inputs
+
+
+def step_hash(process, inputs):
+    """The hash identifying a launch of `process` with `inputs`, or None if the inputs can not be hashed."""
+    canonical = canonical_inputs(inputs)
+    if canonical is None:
+        return None
+    content = json.dumps([f'{process.__module__}.{process.__name__}', canonical], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class StepCache:
+    """
+    Finds the finished processes of cached steps by their `step_hash`. Hashes
+    already seen by this interpreter are looked up in an index of pks before
+    querying the database.
+    """
+    def __init__(self, maxsize=4096):
+        self.index = LRUCache(maxsize=maxsize)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, h):
+        """Returns a process that finished successfully with the hash `h`, or None."""
+        pk = self.index.get(h)
+        if pk is not None:
+            try:
+                node = load_node(pk)
+                if node.is_finished_ok:
+                    self.hits += 1
+                    return node
+            except NotExistent:
+                pass
+
+        existing = orm.QueryBuilder().append(
+            orm.ProcessNode, filters={f'extras.{STEP_HASH_EXTRA}': h, 'attributes.exit_status': 0}, project='id'
+        ).order_by({orm.ProcessNode: {'id': 'desc'}}).first()
+        if existing is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.index.put(h, existing[0])
+        return load_node(existing[0])
+
+    def put(self, h, node):
+        """Marks the launched process `node` with the hash `h`."""
+        node.base.extras.set(STEP_HASH_EXTRA, h)
+        self.index.put(h, node.pk)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'index': self.index.stats()}
 
 
 def get_dot2index(d, key):
@@ -258,12 +778,183 @@ def set_dot2index(d, key, val):
 
         return set_dot2index(d[t], key[1:], val)
 
-class DeclarativeChain(WorkChain):
+
+def freeze(d):
+    """Recursively convert dicts and lists into read-only mappings and tuples."""
+    # Materialize the lazy proxies created for references
+    if isinstance(d, jsonref.JsonRef):
+        return freeze(d.__subject__)
+    elif isinstance(d, dict):
+        return MappingProxyType({k: freeze(v) for k, v in d.items()})
+    elif isinstance(d, (list, tuple)):
+        return tuple(freeze(v) for v in d)
+    else:
+        return d
+
+
+def thaw(d):
+    """
+    Inverse of `freeze`, returns mutable copies that can be stored in the context.
+    Plain dicts and lists are copied as well, so that the copies can be modified
+    without changing the steps of a program that is stored in the context.
+    """
+    if isinstance(d, (dict, MappingProxyType)):
+        return {k: thaw(v) for k, v in d.items()}
+    elif isinstance(d, (list, tuple)):
+        return [thaw(v) for v in d]
+    else:
+        return d
+
+
+def merge_data(data, overrides):
+    """Returns `data` with the values of `overrides` set on top of it, merging nested dicts."""
+    merged = dict(data)
+    for k, v in overrides.items():
+        if isinstance(v, dict) and isinstance(merged.get(k), Mapping):
+            merged[k] = merge_data(merged[k], v)
+        else:
+            merged[k] = v
+    return merged
+
+
+# Fields of a step that launch a process. The children of parallel and map steps need one of them.
+PROCESS_FIELDS = ('calcjob', 'calculation', 'workflow', 'node')
+
+# Fields of control flow steps, which can not be the children of parallel and map steps.
+CONTROL_FIELDS = ('while', 'steps', 'parallel', 'map')
+
+
+def check_children(steps):
+    """Raises a ValueError if a child of a parallel or map step does not launch a single process."""
+    for step in steps:
+        if 'while' in step:
+            check_children(step.get('steps', []))
+
+        children = [('parallel', child) for child in step.get('parallel', [])]
+        if 'map' in step:
+            if 'step' not in step:
+                raise ValueError(f"The map step over `{step['map']}` has no `step` to run.")
+            children.append(('map', step['step']))
+
+        for kind, child in children:
+            control = [k for k in CONTROL_FIELDS if k in child]
+            if control:
+                raise ValueError(f"The steps of a {kind} step can not have a `{control[0]}` field, only steps that launch a process can run in a {kind} step.")
+            if not any(k in child for k in PROCESS_FIELDS):
+                raise ValueError(f"The steps of a {kind} step should launch a process with one of the fields {', '.join(PROCESS_FIELDS)}.")
+
+
+def flatten_inputs(inputs, prefix=''):
+    """
+    Flattens the nested dicts of step inputs into dotted keys, e.g. `{'a': {'b': 1}}`
+    into `{'a.b': 1}`, so that they are set inside the inputs they are added to
+    instead of replacing them. Dicts with an explicit `type` and references to
+    nodes are kept whole.
+    """
+    flat = dict()
+    for k, v in inputs.items():
+        key = f'{prefix}{k}'
+        if isinstance(v, dict) and v and 'type' not in v and list(v) != ['node']:
+            flat.update(flatten_inputs(v, key + '.'))
+        else:
+            flat[key] = v
+    return flat
+
+
+def parse_specification(content, ext):
+    """Parse the raw specification file, without resolving its references, into a frozen document."""
+    if ext in (".yaml", ".yml"):
+        return freeze(YAML(typ="safe").load(content))
+    else:
+        return freeze(json.loads(content))
+
+
+def compile_specification(tspec, overrides=None):
+    """
+    Resolve all the references of the parsed specification `tspec` and validate
+    it. `overrides` are merged into its `data` before the references are resolved.
+    """
+    if overrides:
+        tspec = {**tspec, 'data': merge_data(tspec.get('data') or dict(), overrides)}
+
+    spec = jsonref.JsonRef.replace_refs(tspec, loader=my_fancy_loader)
+    validate(instance=spec, schema=schema)
+    check_children(spec['steps'])
+    if spec.get('schedule', 'sequential') == 'dag':
+        spec = {**spec, 'steps': schedule_steps(spec['steps'], spec.get('max_concurrent'))}
+    program = compile_program(spec['steps'])
+    spec = freeze({**spec, 'program': program, 'early_results': early_results(spec.get('setup', []), program)})
+    return MappingProxyType({**spec, 'program_hash': program_hash(spec['program'])})
+
+
+def program_hash(program):
+    """
+    A hash of a compiled program. Unlike the hash of the specification file, it
+    also covers the documents pulled in through references.
+    """
+    return hashlib.sha256(json.dumps(thaw(program), sort_keys=True, default=str).encode()).hexdigest()
+
+
+def step_label(step):
+    """A short description of a step for its timings, e.g. the entry point of its process."""
+    if 'map' in step:
+        return f"map {step_label(step.get('step', {}))}"
+    elif 'parallel' in step:
+        return 'parallel'
+    elif 'node' in step:
+        return f"node {step['node']}"
+    for k in ('calcjob', 'calculation', 'workflow'):
+        if k in step:
+            return step[k]
+    return ''
+
+
+# Jinja Filters
+# These receive the workchain context through the render arguments rather than
+# being bound to a DeclarativeChain instance, so that compiled templates can be
+# shared between all the chains running in the same interpreter.
+@pass_context
+def to_ctx(context, value, key):
+    context['ctx'][key] = value
+    return value
+
+
+@pass_context
+def to_results(context, value, key):
+    context['ctx'].results[key] = value
+    return value
+
+
+class DeclarativeChain(TimedWorkChain):
+
+    template_env = NativeEnvironment()
+    template_env.filters['to_ctx'] = to_ctx
+    template_env.filters['to_results'] = to_results
+
+    # Compiled templates keyed by their source string. Lives at class level so
+    # that while loops and other chains in the same daemon worker reuse them.
+    template_cache = LRUCache(maxsize=1024)
+
+    # Parsed specification files and their resolved and validated specifications,
+    # both keyed by the hash of the file contents.
+    document_cache = LRUCache(maxsize=64)
+    spec_cache = LRUCache(maxsize=64)
+
+    # Specifications with overrides, kept apart so that the chains of a batch,
+    # which all have different overrides, do not evict the shared ones above.
+    override_cache = LRUCache(maxsize=16)
+
+    # Finished processes of steps with `cache: true`, by the hash of their process type and inputs.
+    step_cache = StepCache()
 
     @classmethod
     def define(cls, spec):
         super().define(spec)
         spec.input('workchain_specification', valid_type=SinglefileData)
+        spec.input('overrides', valid_type=Dict, required=False,
+                   help='Values merged into the `data` of the specification before its references are resolved.')
+        spec.input('compact_checkpoints', valid_type=bool, non_db=True, default=False,
+                   help='Keep only the hash of the specification in the context, and rebuild the program from it when needed.')
         spec.exit_code(2, 'ERROR_SUBPROCESS', message='A subprocess has failed.') 
 
         spec.outline(
@@ -277,145 +968,416 @@ class DeclarativeChain(WorkChain):
         spec.output_namespace('results', dynamic=True)
 
     def setup(self):
-        self.ctx.current_id = 0
+        # [index of the while instruction, iteration] for each loop we are in
+        self.ctx.loops = []
+        # Results that were not returned yet, and the keys of those already returned
         self.ctx.results = dict()
+        self.ctx.result_keys = []
+        # Failed processes of the steps that are being retried, by step key
+        self.ctx.failed_attempts = dict()
 
-        ext = splitext(self.inputs['workchain_specification'].filename)[1]
-        with self.inputs['workchain_specification'].open(mode="r") as f:
-            if ext == ".yaml":
-                tspec = YAML(typ="safe").load(f)
-            else:
-                spec = jsonref.load(f)
-
-        spec = jsonref.JsonRef.replace_refs(tspec, loader = my_fancy_loader)
-        validate(instance=spec, schema=schema)
-        self.ctx.steps = spec['steps']
-        self.env = NativeEnvironment()
-        self.env.filters['to_ctx'] = self.to_ctx
-        self.env.filters['to_results'] = self.to_results
-
-        self.ctx.in_while = False
+        with self.timed('setup', 'specification'):
+            self.ctx.spec_hash, spec = self.load_specification(self.inputs['workchain_specification'], self.overrides)
+        self.label_timings(f"{self.inputs['workchain_specification'].filename} ({self.ctx.spec_hash[:8]})")
+        self.ctx.deduplicate = spec.get('deduplicate', False)
+        self.ctx.submit_process_functions = spec.get('process_functions', 'inline') == 'submit'
+        self.ctx.early_results = list(spec['early_results'])
+        if self.inputs['compact_checkpoints']:
+            self._program = spec['program']
+            self.ctx.program_hash = spec['program_hash']
+        else:
+            self.ctx.program = thaw(spec['program'])
 
         if 'setup' in spec:
             for k in spec['setup']:
                 self.eval_template(k)
+            self.emit_results()
+
+        # Set after the setup templates, so that their timings are not attributed to the first step
+        self.ctx.pc = 0
+
+    @classmethod
+    def load_specification(cls, node, overrides=None):
+        """
+        Returns the content hash and the frozen, resolved specification stored in
+        the SinglefileData `node`, with `overrides` merged into its data. Parsing
+        only happens the first time a given content is seen by this interpreter,
+        reference resolution and validation the first time a given content and
+        overrides are seen.
+        """
+        ext = splitext(node.filename)[1]
+        with node.open(mode="rb") as f:
+            content = f.read()
+
+        key = hashlib.sha256(ext.encode() + content)
+        content_key = key.hexdigest()
+        document = cls.document_cache.get_or_create(content_key, lambda: parse_specification(content, ext))
+        if not overrides:
+            return content_key, cls.spec_cache.get_or_create(content_key, lambda: compile_specification(document))
+
+        key.update(json.dumps(overrides, sort_keys=True).encode())
+        key = key.hexdigest()
+        return key, cls.override_cache.get_or_create(key, lambda: compile_specification(document, overrides))
+
+    @property
+    def overrides(self):
+        """The values to merge into the data of the specification, if any."""
+        return self.inputs['overrides'].get_dict() if 'overrides' in self.inputs else None
+
+    @property
+    def program(self):
+        """
+        The compiled program of this chain. With `compact_checkpoints` it is not
+        stored in the context, and is fetched from the specification cache (or
+        recompiled) the first time it is needed after the process is reloaded.
+        """
+        if 'program' in self.ctx:
+            return self.ctx.program
+
+        if getattr(self, '_program', None) is None:
+            key, spec = self.load_specification(self.inputs['workchain_specification'], self.overrides)
+            if key != self.ctx.spec_hash:
+                raise ValueError('The content of the workchain specification changed since the chain was started.')
+            # Referenced documents are read again, and could have changed as well
+            if spec['program_hash'] != self.ctx.get('program_hash', spec['program_hash']):
+                raise ValueError('The program compiled from the workchain specification and the documents it references changed since the chain was started.')
+            self._program = spec['program']
+        return self._program
+
+    @property
+    def pseudos(self):
+        """Pseudopotential lookups of this chain, kept in memory for as long as the process is loaded."""
+        if getattr(self, '_pseudos', None) is None:
+            self._pseudos = PseudoResolver()
+        return self._pseudos
 
     def not_finished(self):
-        return self.ctx.current_id < len(self.ctx.steps)
+        self.advance()
+        return self.ctx.pc < len(self.program)
+
+    def advance(self):
+        """
+        Executes control flow instructions until the program counter points
+        to a step that should be run, or past the end of the program.
+        """
+        program = self.program
+        while self.ctx.pc < len(program):
+            instruction = program[self.ctx.pc]
+            op = instruction['op']
+            if op == 'run':
+                return
+
+            if op == 'skip':
+                self.label_timings('if', self.ctx.pc)
+                if self.eval_template(instruction['if']):
+                    self.ctx.pc += 1
+                else:
+                    self.ctx.pc = instruction['target']
+
+            elif op == 'while':
+                self.label_timings('while', self.ctx.pc)
+                in_loop = len(self.ctx.loops) > 0 and self.ctx.loops[-1][0] == self.ctx.pc
+                if self.eval_template(instruction['cond']):
+                    if in_loop:
+                        self.ctx.loops[-1][1] += 1
+                    else:
+                        self.ctx.loops.append([self.ctx.pc, 0])
+                    self.ctx.pc += 1
+                else:
+                    if in_loop:
+                        self.ctx.loops.pop()
+                    self.ctx.pc = instruction['end']
+
+            elif op == 'loop':
+                self.ctx.pc = instruction['start']
+
+            else:
+                raise ValueError(f"Unrecognized instruction {instruction}")
 
     def submit_next(self):
+        step = self.program[self.ctx.pc]['step']
+        self.label_timings(step_label(step), self.ctx.pc)
+        self.ctx.pop('retry_at', None)
+        if "parallel" in step:
+            # All children are launched in this pass and awaited together,
+            # or only those that are retried.
+            retry = self.ctx.pop('parallel_retry', None)
+            self.ctx.parallel_ids = []
+            futures = dict()
+            for i, child in enumerate(step['parallel']):
+                if retry is not None:
+                    if i not in retry:
+                        continue
+                elif 'if' in child and not self.eval_template(child['if']):
+                    continue
 
-        id = self.ctx.current_id
-        step = self.ctx.steps[id]
-        if 'if' in step and not self.eval_template(step['if']):
-            self.ctx.current_id += 1
-            return self.submit_next()
-
-        elif "while" in step:
-            if self.eval_template(step['while']):
-                if not self.ctx.in_while:
-                    # Enter the while loop
-                    self.ctx.in_while = True
-                    self.ctx.while_first_id = len(self.ctx.steps)
-                    self.ctx.while_entry_id = id
-                    self.ctx.steps += step['steps']
-                    self.ctx.current_id = self.ctx.while_first_id
+                self.ctx.parallel_ids.append(i)
+                node = self.run_step(child, key=f'{self.ctx.pc}.{i}')
+                if isinstance(node, orm.ProcessNode):
+                    futures[f'parallel_{i}'] = node
                 else:
-                    # Reroll the while loop
-                    self.ctx.current_id = self.ctx.while_first_id
+                    self.ctx[f'parallel_{i}'] = node
 
-            elif self.ctx.in_while:
-                # Cleanup while loop
-                self.ctx.in_while = False
-                self.ctx.steps = self.ctx.steps[0:-len(step['steps'])]
-                self.ctx.current_id += 1
+            self.start_waiting(self.ctx.pc)
+            return ToContext(**futures)
 
-            return self.submit_next()
+        elif "map" in step:
+            # Evaluate the iterable once, then launch instances of the step in
+            # waves of at most max_in_flight processes.
+            if 'map_items' not in self.ctx:
+                self.ctx.map_items = list(self.eval_template(step['map']))
+                self.ctx.map_offset = 0
 
-        else:
-            if "node" in step:
-                self.ctx.current = load_node(step['node'])
-
-            elif "calcjob" in step or "workflow" in step or "calculation" in step:
-                # This needs to happen because no dict 2 node for now.
-                inputs = dict()
-                if "calcjob" in step:
-                    cjob = CalculationFactory(step['calcjob'])
-                elif "calculation" in step:
-                    cjob = WorkflowFactory(step['calculation'])
-                elif "workflow" in step:
-                    cjob = WorkflowFactory(step['workflow'])
+            if 'map_retry' in self.ctx:
+                self.ctx.map_ids = self.ctx.pop('map_retry')
+            else:
+                n = step.get('max_in_flight', len(self.ctx.map_items))
+                self.ctx.map_ids = list(range(self.ctx.map_offset, min(self.ctx.map_offset + n, len(self.ctx.map_items))))
+                self.ctx.map_offset += len(self.ctx.map_ids)
+            futures = dict()
+            for i in self.ctx.map_ids:
+                node = self.run_step(step['step'], self.map_variables(step, i), key=f'{self.ctx.pc}.{i}')
+                if isinstance(node, orm.ProcessNode):
+                    futures[f'map_{i}'] = node
                 else:
-                    ValueError(f"Unrecognized step {step}")
-
-                spec_inputs = cjob.spec().inputs
-                for k in step['inputs']:
-                    valid_type = None
-                    if k in spec_inputs:
-                        i = spec_inputs.get(k)
-                        valid_type = i.valid_type
-
-                    d = step['inputs'][k]
-                    if isinstance(d, dict):
-                        if 'type' in d:
-                            valid_type = DataFactory(d.pop('type'))
-
-                        if 'value' in d:
-                            val = d['value']
-                        else:
-                            val = d
-                    else:
-                        val = d
-
-                    if isinstance(val, str):
-                        val = self.eval_template(val)
-
-                    if valid_type is not None and not isinstance(val, valid_type):
-                        valid_type = valid_type[0] if isinstance(valid_type, tuple) else valid_type
-                        if k in spec_inputs:
-                            val = dict2datanode(val, valid_type, isinstance(i, plumpy.PortNamespace))
-                        else:
-                            val = dict2datanode(val, valid_type)
-                    elif k != 'metadata' and not isinstance(val, orm.Data):
-                        val = orm.to_aiida_type(val)
-
-                    set_dot2index(inputs, k, val)
-                # print(cjob)
-                if is_process_function(cjob):
-                    return ToContext(current = run_get_node(cjob, **inputs)[1])
+                    self.ctx[f'map_{i}'] = node
+
+            self.start_waiting(self.ctx.pc)
+            return ToContext(**futures)
+
+        else:
+            node = self.run_step(step, key=f'{self.ctx.pc}')
+            if isinstance(node, orm.ProcessNode):
+                self.start_waiting(self.ctx.pc)
+                return ToContext(current=node)
+            else:
+                self.ctx.current = node
+
+    def run_step(self, step, variables=None, key=None):
+        """
+        Launches the process described by a single step and returns its node
+        without waiting for it to finish. `variables` are passed to the templates
+        in the inputs of the step. When the step with key `key` is retried, the
+        `inputs` of its `retry` block are set inside its inputs, and the number
+        of failed attempts and the last failed process are available to the
+        templates as `attempt` and `previous`.
+        """
+        if "node" in step:
+            return load_node(step['node'])
+
+        if "calcjob" in step:
+            cjob = CalculationFactory(step['calcjob'])
+        elif "calculation" in step:
+            cjob = WorkflowFactory(step['calculation'])
+        elif "workflow" in step:
+            cjob = WorkflowFactory(step['workflow'])
+        else:
+            raise ValueError(f"Unrecognized step {step}")
+
+        plan = input_plan(cjob)
+
+        step_inputs = step['inputs']
+        failed = self.ctx.failed_attempts.get(key, [])
+        if failed:
+            step_inputs = {**step_inputs, **flatten_inputs(thaw(step['retry'].get('inputs', {})))}
+            variables = {**(variables or {}), 'attempt': len(failed), 'previous': failed[-1]}
+
+        values, types = plan.raw_values(step_inputs, lambda val: self.eval_template(val, **(variables or {})))
+        with self.timed(self.ctx.pc, 'convert'):
+            inputs = plan.inputs(values, types, self.pseudos)
+            if self.ctx.deduplicate:
+                inputs = deduplicate_inputs(inputs)
+
+        h, node = None, None
+        if step.get('cache', False):
+            with self.timed(self.ctx.pc, 'cache'):
+                h = step_hash(cjob, inputs)
+                node = self.step_cache.get(h) if h is not None else None
+            if node is not None:
+                self.report(f'Reusing the outputs of {node.process_label}<{node.pk}> for a cached step.')
+                return node
+
+        with self.timed(self.ctx.pc, 'launch'):
+            if is_process_function(cjob):
+                # Submitted process functions still run synchronously, but on whichever
+                # daemon worker picks them up, which spreads them over the workers.
+                if self.ctx.submit_process_functions:
+                    node = self.submit(cjob.process_class, **inputs)
                 else:
-                    return ToContext(current=self.submit(cjob, **inputs))
-                    
+                    node = run_get_node(cjob, **inputs)[1]
+            else:
+                node = self.submit(cjob, **inputs)
+
+        if h is not None:
+            self.step_cache.put(h, node)
+        return node
 
     def process_current(self):
-        step = self.ctx.steps[self.ctx.current_id]
+        self.stop_waiting()
+        step = self.program[self.ctx.pc]['step']
+        if "parallel" in step:
+            retry, delays = [], []
+            for i in self.ctx.parallel_ids:
+                self.ctx.current = self.ctx.pop(f'parallel_{i}')
+                delay = self.retry_delay(step['parallel'][i], f'{self.ctx.pc}.{i}')
+                if delay is not None:
+                    retry.append(i)
+                    delays.append(delay)
+                    continue
+
+                exit_code = self.process_step(step['parallel'][i])
+                if exit_code is not None:
+                    return exit_code
+
+            if retry:
+                # Launch the failed children again, keeping those that finished
+                self.ctx.parallel_retry = retry
+                self.back_off(max(delays))
+                return
+        elif "map" in step:
+            retry, delays = [], []
+            for i in self.ctx.map_ids:
+                self.ctx.current = self.ctx.pop(f'map_{i}')
+                delay = self.retry_delay(step['step'], f'{self.ctx.pc}.{i}')
+                if delay is not None:
+                    retry.append(i)
+                    delays.append(delay)
+                    continue
+
+                exit_code = self.process_step(step['step'], self.map_variables(step, i))
+                if exit_code is not None:
+                    return exit_code
+
+                if 'results' in step and self.ctx.current.is_finished_ok:
+                    if 'output' in step:
+                        result = self.ctx.current.outputs[step['output']]
+                    else:
+                        result = self.ctx.current.base.links.get_outgoing(link_type=(LinkType.CREATE, LinkType.RETURN)).nested()
+                    self.ctx.results[f"{step['results']}.{i}"] = result
+                    self.emit_results()
+
+            if retry:
+                self.ctx.map_retry = retry
+                self.back_off(max(delays))
+                return
+
+            if self.ctx.map_offset < len(self.ctx.map_items):
+                # Launch the next wave of the same step
+                return
+
+            for k in ('map_items', 'map_offset', 'map_ids'):
+                del self.ctx[k]
+
+        else:
+            delay = self.retry_delay(step, f'{self.ctx.pc}')
+            if delay is not None:
+                self.back_off(delay)
+                return
+
+            exit_code = self.process_step(step)
+            if exit_code is not None:
+                return exit_code
+
+        self.ctx.pc += 1
+
+    def retry_delay(self, step, key):
+        """
+        Decides whether the step with key `key` should be launched again because
+        `ctx.current` failed, according to the `retry` block of `step`. If so, the
+        failed attempt is recorded and the delay in seconds before the next one
+        is returned, otherwise None.
+        """
+        node = self.ctx.current
+        retry = step.get('retry')
+        if retry is None or not isinstance(node, orm.ProcessNode) or node.is_finished_ok:
+            self.ctx.failed_attempts.pop(key, None)
+            return None
+
+        failed = self.ctx.failed_attempts.get(key, []) + [node]
+        codes = retry.get('exit_codes')
+        if len(failed) >= retry.get('max_attempts', 3) or (codes is not None and node.exit_status not in codes):
+            self.ctx.failed_attempts.pop(key, None)
+            return None
+
+        self.ctx.failed_attempts[key] = failed
+        delay = retry.get('backoff', 0) * retry.get('factor', 2) ** (len(failed) - 1)
+        if 'max_backoff' in retry:
+            delay = min(delay, retry['max_backoff'])
+        self.report(f'Attempt {len(failed)} of step {key} failed with exit status {node.exit_status}, retrying in {delay:g} seconds.')
+        return delay
+
+    def back_off(self, delay):
+        """Pauses the chain for `delay` seconds before the next step."""
+        if delay <= 0:
+            return
+        self.ctx.retry_at = time.time() + delay
+        self.pause(f'Waiting {delay:g} seconds before retrying a failed step.')
+        self.loop.call_later(delay, self.play)
+
+    def load_instance_state(self, saved_state, load_context):
+        super().load_instance_state(saved_state, load_context)
+        # A chain that was reloaded while waiting to retry a step continues once the delay has passed
+        if 'retry_at' in self.ctx:
+            self.loop.call_later(max(self.ctx.retry_at - time.time(), 0), self.play)
+
+    def process_step(self, step, variables=None):
+        """Checks the outcome of `ctx.current` and runs the postprocessing of `step` on it."""
         if not self.ctx.current.is_finished_ok:
             self.report(f'A subprocess failed with exit status {self.ctx.current.exit_status}: {self.ctx.current.exit_message}')
             if 'error' in step:
-                validate(step['error'], schema=ExitCode_schema)
+                validate(thaw(step['error']), schema=ExitCode_schema)
                 return ExitCode(step['error']['code']) if 'message' not in step['error'] else ExitCode(step['error']['code'], message=step['error']['message'])
 
         if "postprocess" in step:
             for k in step["postprocess"]:
-                self.eval_template(k)
+                self.eval_template(k, **(variables or {}))
+            self.emit_results()
 
-        self.ctx.current_id += 1
-
-        if self.ctx.in_while and self.ctx.current_id == len(self.ctx.steps):
-            self.ctx.current_id = self.ctx.while_entry_id
+    def map_variables(self, step, i):
+        """The template variables of the `i`-th instance of a map step."""
+        return {step.get('as', 'item'): self.ctx.map_items[i], 'index': i}
 
     # Jinja evaluation
-    def eval_template(self, s):
-        return self.env.from_string(s).render(ctx=self.ctx)
+    def eval_template(self, s, **variables):
+        with self.timed(self.ctx.get('pc', 'setup'), 'render'):
+            template = self.template_cache.get_or_create(s, lambda: self.template_env.from_string(s))
+            iteration = self.ctx.loops[-1][1] if self.ctx.loops else None
+            return template.render(ctx=self.ctx, iteration=iteration, **variables)
+
+    @classmethod
+    def template_cache_stats(cls):
+        """Hits, misses and size of the compiled template cache of this interpreter."""
+        return cls.template_cache.stats()
+
+    @classmethod
+    def spec_cache_stats(cls):
+        """Hits, misses and size of the specification cache of this interpreter."""
+        return cls.spec_cache.stats()
+
+    @classmethod
+    def step_cache_stats(cls):
+        """Hits and misses of the lookups of cached steps in this interpreter, and the state of their index."""
+        return cls.step_cache.stats()
 
-    # Jinja Filters
-    def to_ctx(self, value, key):
-        self.ctx[key] = value
-        return value
+    def is_early_result(self, key):
+        """Whether the result `key` is only set once, see `early_results`, or is an entry of such a result."""
+        return any(key == k or key.startswith(k + '.') for k in self.ctx.early_results)
 
-    def to_results(self, value, key):
-        self.ctx.results[key] = value
-        return value
+    def emit_results(self, final=False):
+        """
+        Returns the results set since the last call in the `results` namespace.
+        Results that are only set once are returned right away, so that they
+        are visible while the chain is still running, and only their keys are
+        kept in the context. The others, e.g. those set inside a while loop,
+        stay in the context until the `final` call, which returns their last value.
+        """
+        for key in list(self.ctx.results):
+            if not final and not self.is_early_result(key):
+                continue
+            if key in self.ctx.result_keys:
+                raise ValueError(f'The result `{key}` was already returned and can not be set again.')
+            self.out(f'results.{key}', self.ctx.results.pop(key))
+            self.ctx.result_keys.append(key)
 
     def finalize(self):
-        self.out('results', self.ctx.results)
+        self.emit_results(final=True)
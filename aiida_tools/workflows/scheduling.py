@@ -0,0 +1,255 @@
+from jinja2 import Environment, nodes
+
+# Only used to parse templates, so it does not need to know about the filters.
+parse_env = Environment()
+
+
+def overlaps(a, b):
+    """Whether two context keys such as `nscf` and `nscf.dir` refer to overlapping data."""
+    return a == b or a.startswith(b + '.') or b.startswith(a + '.')
+
+
+def template_references(s):
+    """
+    Returns the sets of context keys read and written by the template `s`,
+    or None if these can not be determined statically, e.g. when `ctx` is
+    indexed with a variable.
+    """
+    reads, writes = set(), set()
+
+    def visit(node):
+        if isinstance(node, (nodes.Getattr, nodes.Getitem)) and isinstance(node.node, nodes.Name) and node.node.name == 'ctx':
+            if isinstance(node, nodes.Getattr):
+                reads.add(node.attr)
+            elif isinstance(node.arg, nodes.Const) and isinstance(node.arg.value, str):
+                reads.add(node.arg.value)
+            else:
+                return False
+            return True
+
+        if isinstance(node, nodes.Name) and node.name == 'ctx':
+            return False
+
+        if isinstance(node, nodes.Filter) and node.name in ('to_ctx', 'to_results'):
+            if len(node.args) != 1 or not isinstance(node.args[0], nodes.Const):
+                return False
+            key = str(node.args[0].value)
+            writes.add(key if node.name == 'to_ctx' else f'results.{key}')
+
+        return all(visit(c) for c in node.iter_child_nodes())
+
+    if not visit(parse_env.parse(s)):
+        return None
+    return reads, writes
+
+
+def result_writes(s):
+    """The keys set with `to_results` by the template `s`, None for the keys that are not constants."""
+    keys = []
+    for node in parse_env.parse(s).find_all(nodes.Filter):
+        if node.name == 'to_results':
+            if len(node.args) == 1 and isinstance(node.args[0], nodes.Const):
+                keys.append(str(node.args[0].value))
+            else:
+                keys.append(None)
+    return keys
+
+
+def collect_templates(d):
+    """All the strings in a (nested) step input, these are rendered as templates."""
+    if isinstance(d, str):
+        return [d]
+    elif isinstance(d, dict):
+        return [s for v in d.values() for s in collect_templates(v)]
+    elif isinstance(d, (list, tuple)):
+        return [s for v in d for s in collect_templates(v)]
+    else:
+        return []
+
+
+def step_references(step):
+    """
+    Returns the context keys a step reads when it is launched, reads during
+    its postprocessing, writes when it is launched and writes during its
+    postprocessing. Returns None for steps that have to run on their own, i.e.
+    control flow and steps whose templates can not be analysed.
+    """
+    if 'while' in step or 'parallel' in step or 'map' in step:
+        return None
+
+    launch = collect_templates(step.get('inputs', {})) + collect_templates(step.get('retry', {}).get('inputs', {}))
+    if 'if' in step:
+        launch.append(step['if'])
+
+    launch_reads, post_reads, launch_writes, post_writes = set(), set(), set(), set()
+    for s in launch:
+        refs = template_references(s)
+        if refs is None:
+            return None
+        launch_reads |= refs[0]
+        launch_writes |= refs[1]
+
+    for s in step.get('postprocess', []):
+        refs = template_references(s)
+        if refs is None:
+            return None
+        post_reads |= refs[0]
+        post_writes |= refs[1]
+
+    # ctx.current is the step's own process during postprocessing, but the
+    # previous one while it is launched.
+    post_reads.discard('current')
+    return launch_reads, post_reads, launch_writes, post_writes
+
+
+def schedule_steps(steps, max_concurrent=None):
+    """
+    Rewrites a sequential list of steps into waves of `parallel` steps based
+    on the context keys they read and write, so that every step is launched as
+    soon as the steps it depends on have been postprocessed.
+
+    A step has to wait for an earlier step if it reads, at launch time, a key
+    written by it, or if it writes, at launch time, a key the earlier step
+    reads or writes during its postprocessing. Other overlaps between an
+    earlier and a later step (e.g. both write the same key during their
+    postprocessing) only require that the later step does not end up in an
+    earlier wave: the children of a wave are launched, and then postprocessed,
+    in their original order. Control flow steps act as barriers, the bodies of while
+    loops are scheduled separately. Waves are split so that no more than
+    `max_concurrent` steps run at the same time.
+    """
+    out = []
+    segment = []
+
+    def flush():
+        levels = []
+        for j, (_, refs_j) in enumerate(segment):
+            level = 0
+            for i in range(j):
+                launch_i, post_i, launch_writes_i, post_writes_i = segment[i][1]
+                launch_j, post_j, launch_writes_j, post_writes_j = refs_j
+                writes_i = launch_writes_i | post_writes_i
+                writes_j = launch_writes_j | post_writes_j
+                if any(overlaps(r, w) for r in launch_j for w in writes_i) or \
+                   any(overlaps(w, k) for w in launch_writes_j for k in post_i | post_writes_i):
+                    level = max(level, levels[i] + 1)
+                elif any(overlaps(a, b) for a in launch_i | post_i | writes_i for b in writes_j) or \
+                     any(overlaps(r, w) for r in post_j for w in writes_i):
+                    level = max(level, levels[i])
+            levels.append(level)
+
+        for level in range(max(levels, default=-1) + 1):
+            wave = [step for (step, _), l in zip(segment, levels) if l == level]
+            n = max_concurrent or len(wave)
+            for k in range(0, len(wave), n):
+                chunk = wave[k:k + n]
+                out.append(chunk[0] if len(chunk) == 1 else {'parallel': chunk})
+        segment.clear()
+
+    for step in steps:
+        refs = step_references(step)
+        # A step that uses the previous process when it is launched can not be
+        # moved away from it.
+        if refs is not None and 'current' in refs[0]:
+            refs = None
+            if segment:
+                last = segment.pop()
+                flush()
+                out.append(last[0])
+
+        if refs is None:
+            flush()
+            if 'while' in step:
+                step = {**step, 'steps': schedule_steps(step['steps'], max_concurrent)}
+            out.append(step)
+        else:
+            segment.append((step, refs))
+
+    flush()
+    return out
+
+
+def compile_program(steps):
+    """
+    Flattens (nested) steps into a list of instructions with jump targets:
+
+    - `{'op': 'run', 'step': step}` launches a step,
+    - `{'op': 'skip', 'if': cond, 'target': i}` jumps to `i` if `cond` is false,
+    - `{'op': 'while', 'cond': cond, 'end': i}` enters a loop, or jumps to `i` if `cond` is false,
+    - `{'op': 'loop', 'start': i}` jumps back to the `while` instruction at `i`.
+    """
+    program = []
+
+    def emit(steps):
+        for step in steps:
+            if 'if' in step:
+                skip = {'op': 'skip', 'if': step['if']}
+                program.append(skip)
+
+            if 'while' in step:
+                head = {'op': 'while', 'cond': step['while']}
+                start = len(program)
+                program.append(head)
+                emit(step['steps'])
+                program.append({'op': 'loop', 'start': start})
+                head['end'] = len(program)
+            else:
+                program.append({'op': 'run', 'step': {k: v for k, v in step.items() if k != 'if'}})
+
+            if 'if' in step:
+                skip['target'] = len(program)
+
+    emit(steps)
+    return program
+
+
+def step_result_writes(step, repeated=False):
+    """
+    Returns `(key, repeated)` for every result set by `step`, where `repeated`
+    tells whether the template that sets it can be rendered more than once,
+    i.e. in the instances of a map step or the inputs of a retried step.
+    """
+    if 'parallel' in step:
+        return [w for child in step['parallel'] for w in step_result_writes(child, repeated)]
+
+    if 'map' in step:
+        writes = [(k, repeated) for k in result_writes(step['map'])]
+        if 'results' in step:
+            writes.append((step['results'], repeated))
+        return writes + step_result_writes(step['step'], True)
+
+    launch = collect_templates(step.get('inputs', {})) + collect_templates(step.get('retry', {}).get('inputs', {}))
+    once = step.get('postprocess', []) + ([step['if']] if 'if' in step else [])
+    return [(k, repeated or 'retry' in step) for s in launch for k in result_writes(s)] + \
+           [(k, repeated) for s in once for k in result_writes(s)]
+
+
+def early_results(setup, program):
+    """
+    The keys of the results that are set at most once while a chain runs: by a
+    single template or map step, outside of while loops, and not overlapping
+    with any other result. These can be returned as soon as they are set, the
+    others are returned with their last value when the chain finishes. If the
+    key of a result is not a constant it could overlap with any other, and no
+    result is returned early.
+    """
+    writes = [(k, False) for s in setup for k in result_writes(s)]
+    depth = 0
+    for instruction in program:
+        op = instruction['op']
+        if op == 'while':
+            depth += 1
+            writes += [(k, True) for k in result_writes(instruction['cond'])]
+        elif op == 'loop':
+            depth -= 1
+        elif op == 'skip':
+            writes += [(k, depth > 0) for k in result_writes(instruction['if'])]
+        elif op == 'run':
+            writes += [(k, depth > 0 or repeated) for k, repeated in step_result_writes(instruction['step'])]
+
+    if any(k is None for k, _ in writes):
+        return []
+    return sorted({
+        k for k, repeated in writes
+        if not repeated and sum(overlaps(k, other) for other, _ in writes) == 1
+    })
@@ -1,16 +1,113 @@
-from aiida.orm import Dict, SinglefileData 
-from aiida.engine import WorkChain, ToContext, while_
+from aiida.orm import Dict, SinglefileData, List, Str, Bool
+from aiida.engine import ToContext, while_, calcfunction
 from ..calculations.script import Script
+from .timings import TimedWorkChain
 
+CONFLICT_POLICIES = ('error', 'first', 'last')
 
-class ScriptChain(WorkChain):
+# Value of a removed key when comparing the changes made by scripts
+REMOVED = object()
+
+
+def script_order(keys):
+    """Sorts script keys numerically where possible, i.e. '2' comes before '10'."""
+    return sorted(keys, key=lambda k: (not k.isdigit(), int(k) if k.isdigit() else 0, k))
+
+
+def merge_context_dicts(contexts, policy='error'):
+    """
+    Merges the contexts written by scripts that ran in parallel. `contexts` is a
+    list of (context given to the script, context written by the script) pairs.
+    Keys that a script did not change never conflict. If several scripts changed
+    a key to different values, `first` and `last` keep the value of the first or
+    last of them in the order of `contexts`, while `error` reports the key.
+    Returns the merged dict and the list of conflicting keys.
+    """
+    merged = dict()
+    changed = set()
+    conflicts = []
+    for before, after in contexts:
+        for k, v in after.items():
+            if k in before and before[k] == v:
+                merged.setdefault(k, v)
+                continue
+
+            if k in changed and merged[k] != v:
+                if policy == 'error' and k not in conflicts:
+                    conflicts.append(k)
+                if policy != 'last':
+                    continue
+
+            merged[k] = v
+            changed.add(k)
+
+    return merged, conflicts
+
+
+def merge_patch_chains(chains, policy='error'):
+    """
+    Merges contexts represented as chains of nodes, a base context followed by
+    patches. Patches shared by all chains are kept in front, followed by the
+    patches specific to each chain, in the order of `chains` or in reverse for
+    the `first` policy so that the values of the first chain are applied last.
+    Returns the merged chain and the list of keys that are set to different
+    values by different chains.
+    """
+    shared = [n for n in chains[0] if all(n.uuid in {m.uuid for m in c} for c in chains[1:])]
+    seen = {n.uuid for n in shared}
+    blocks = []
+    for chain in chains:
+        block = [n for n in chain if n.uuid not in seen]
+        seen.update(n.uuid for n in block)
+        blocks.append(block)
+
+    # What every chain changed on top of the shared patches
+    changes = []
+    for block in blocks:
+        change = dict()
+        for patch in block:
+            p = patch.get_dict()
+            change.update({k: REMOVED for k in p.get('unset', [])})
+            change.update(p.get('set', {}))
+        changes.append((dict(), change))
+    _, conflicts = merge_context_dicts(changes, policy)
+
+    if policy == 'first':
+        blocks.reverse()
+    return shared + [n for block in blocks for n in block], conflicts
+
+
+@calcfunction
+def merge_contexts(policy, **contexts):
+    """Merges the output contexts of parallel scripts, passed as `context_0`, `context_1`, ... in order."""
+    keys = sorted(contexts, key=lambda k: int(k.split('_')[-1]))
+    pairs = [(contexts[k].creator.inputs['context'].get_dict(), contexts[k].get_dict()) for k in keys]
+    return Dict(dict=merge_context_dicts(pairs, policy.value)[0])
+
+
+class ScriptChain(TimedWorkChain):
     """
     A basic modular WorkChain that runs a series of scripts using the specified code.
-    Each script has an associated set of input parameters.
+    Each script has an associated set of input parameters.
     Communcation between the scripts is facilitated through files in json format,
     which are passed as commandline arguments. See the Script calculation for more
     information. Each script is expected to write a results file in json format,
     which is read back into the results output.
+
+    By default the scripts run one after the other, in the order of their keys.
+    The optional `dependencies` namespace lists, for each script, the scripts
+    whose context it needs. All scripts whose dependencies have finished are then
+    submitted together, and the contexts of several dependencies are merged
+    according to `conflict_policy`.
+
+    With `delta_context` the scripts only store the changes they make to the
+    context, and every script receives the initial context together with the
+    patches of all the scripts it depends on, directly or not.
+
+    With `remote_handoff` every script gets the remote working directories of
+    the scripts it depends on as `parent_folders`, available in directories named
+    after their keys, and array results are only retrieved for the scripts that
+    no other script depends on.
     """
 
     @classmethod
@@ -18,22 +115,31 @@ class ScriptChain(WorkChain):
         super().define(spec)
         spec.input_namespace('scripts', dynamic=True, valid_type=SinglefileData)
         spec.input_namespace('parameters', dynamic=True, valid_type=Dict)
+        spec.input_namespace('dependencies', dynamic=True, valid_type=List, required=False,
+                             help='The keys of the scripts that have to finish before each script can run.')
+        spec.input('conflict_policy', valid_type=Str, default=lambda: Str('error'),
+                   help='How to merge contexts in which parallel scripts set the same key: `error`, `first` or `last`.')
+        spec.input('delta_context', valid_type=Bool, default=lambda: Bool(False),
+                   help='Pass the context between scripts as patches instead of storing a full copy for every script.')
+        spec.input('remote_handoff', valid_type=Bool, default=lambda: Bool(False),
+                   help='Give every script the remote working directories of its dependencies, and only retrieve the arrays of the last scripts.')
         spec.inputs.validator = cls.check_inputs
-        spec.expose_inputs(Script, exclude=['script', 'parameters', 'context'], namespace='script')
+        spec.expose_inputs(Script, exclude=['script', 'parameters', 'context', 'context_patches', 'delta_context', 'parent_folders', 'retrieve_arrays'], namespace='script')
         spec.outline(
             cls.setup,
             while_(cls.finished)(
                 cls.submit_next,
                 cls.process_current
             ),
-            cls.finalize
         )
         spec.output_namespace('results', dynamic = True)
+        spec.exit_code(2, 'ERROR_SUBPROCESS', message='Script {key} failed.')
+        spec.exit_code(3, 'ERROR_CONTEXT_CONFLICT', message='Scripts that ran in parallel set the context keys {keys} to different values.')
 
     @classmethod
     def check_inputs(self, inputs, _):
         scripts = inputs['scripts']
-        parameters = inputs['scripts']
+        parameters = inputs['parameters']
         if len(scripts) != len(parameters):
             return 'ERROR: length of scripts and parameters inputs are not equal.'
 
@@ -41,27 +147,115 @@ class ScriptChain(WorkChain):
             if k not in parameters:
                 return f'ERROR: key {k} not found in parameters.'
 
+        if inputs['conflict_policy'].value not in CONFLICT_POLICIES:
+            return f"ERROR: conflict_policy should be one of {', '.join(CONFLICT_POLICIES)}."
+
+        dependencies = {k: v.get_list() for k, v in inputs.get('dependencies', {}).items()}
+        for k, deps in dependencies.items():
+            if k not in scripts:
+                return f'ERROR: dependencies given for unknown script {k}.'
+            for d in deps:
+                if d not in scripts:
+                    return f'ERROR: script {k} depends on unknown script {d}.'
+
+        # Every script has to become ready at some point
+        done = set()
+        while len(done) < len(dependencies):
+            ready = [k for k, deps in dependencies.items() if k not in done and all(d in done or d not in dependencies for d in deps)]
+            if not ready:
+                return f"ERROR: circular dependencies between scripts {', '.join(sorted(set(dependencies) - done))}."
+            done.update(ready)
+
     def setup(self):
-        self.ctx.n = 0
-        self.ctx.results = dict()
-        self.ctx.context = Dict()
+        # Output context of every finished script, with `delta_context` a list
+        # of the initial context followed by patches
+        self.ctx.contexts = dict()
+        self.ctx.submitted = []
+        self.ctx.context = Dict().store()
+        self.ctx.delta = self.inputs['delta_context'].value
+        # Context chain given to every running script
+        self.ctx.chains = dict()
+        self.ctx.remote_folders = dict()
+
+        order = script_order(self.inputs['scripts'].keys())
+        if 'dependencies' in self.inputs:
+            deps = self.inputs['dependencies']
+            self.ctx.dependencies = {k: deps[k].get_list() if k in deps else [] for k in order}
+        else:
+            self.ctx.dependencies = {k: order[i - 1:i] for i, k in enumerate(order)}
 
     def finished(self):
-        return self.ctx.n < len(self.inputs['scripts']) 
+        return len(self.ctx.contexts) < len(self.inputs['scripts'])
 
     def submit_next(self):
-        n = self.ctx.n
-        param = self.inputs['parameters'][f'{n}']
-        script = self.inputs['scripts'][f'{n}']
+        ready = [k for k, deps in self.ctx.dependencies.items()
+                 if k not in self.ctx.contexts and all(d in self.ctx.contexts for d in deps)]
+
+        self.ctx.submitted = ready
+        futures = dict()
+        for k in ready:
+            self.label_timings(self.inputs['scripts'][k].filename, k)
+            with self.timed(k, 'context'):
+                context = self.merged_context(self.ctx.dependencies[k])
+            if context is None:
+                return self.exit_codes.ERROR_CONTEXT_CONFLICT.format(keys=', '.join(self.ctx.conflicts))
+
+            inputs = {'parameters': self.inputs['parameters'][k], 'script': self.inputs['scripts'][k], **self.exposed_inputs(Script, 'script')}
+            if self.ctx.delta:
+                inputs['context'] = context[0]
+                inputs['context_patches'] = {f'{i}': p for i, p in enumerate(context[1:])}
+                inputs['delta_context'] = Bool(True)
+                self.ctx.chains[k] = context
+            else:
+                inputs['context'] = context
+
+            if self.inputs['remote_handoff'].value:
+                inputs['parent_folders'] = {d: self.ctx.remote_folders[d] for d in self.ctx.dependencies[k]}
+                inputs['retrieve_arrays'] = Bool(not any(k in deps for deps in self.ctx.dependencies.values()))
+            with self.timed(k, 'submit'):
+                futures[f'script_{k}'] = self.submit(Script, **inputs)
+
+        self.start_waiting(*ready)
+        return ToContext(**futures)
+
+    def merged_context(self, dependencies):
+        """
+        The context to pass to a script that depends on the scripts `dependencies`.
+        Returns None if their contexts conflict and the policy is `error`.
+        """
+        if not dependencies:
+            return [self.ctx.context] if self.ctx.delta else self.ctx.context
+        elif len(dependencies) == 1:
+            return self.ctx.contexts[dependencies[0]]
+
+        policy = self.inputs['conflict_policy']
+        if self.ctx.delta:
+            chain, conflicts = merge_patch_chains([self.ctx.contexts[d] for d in dependencies], policy.value)
+            if conflicts:
+                self.ctx.conflicts = conflicts
+                return None
+            return chain
 
-        inputs = {'context': self.ctx.context, 'parameters': param, 'script': script, **self.exposed_inputs(Script, 'script')}
+        contexts = [self.ctx.contexts[d] for d in dependencies]
+        _, conflicts = merge_context_dicts([(c.creator.inputs['context'].get_dict(), c.get_dict()) for c in contexts], policy.value)
+        if conflicts:
+            self.ctx.conflicts = conflicts
+            return None
 
-        return ToContext(current_script = self.submit(Script, **inputs))
+        return merge_contexts(policy, **{f'context_{i}': c for i, c in enumerate(contexts)})
 
     def process_current(self):
-        self.ctx.results[f'{self.ctx.n}'] = self.ctx.current_script.outputs['results']
-        self.ctx.context = self.ctx.current_script.outputs['context']
-        self.ctx.n += 1
+        self.stop_waiting()
+        for k in self.ctx.submitted:
+            node = self.ctx[f'script_{k}']
+            if not node.is_finished_ok:
+                self.report(f'Script {k} failed with exit status {node.exit_status}: {node.exit_message}')
+                return self.exit_codes.ERROR_SUBPROCESS.format(key=k)
 
-    def finalize(self):
-        self.out('results', self.ctx.results)
+            self.out(f'results.{k}', node.outputs['results'])
+            self.ctx.remote_folders[k] = node.outputs['remote_folder']
+            if not self.ctx.delta:
+                self.ctx.contexts[k] = node.outputs['context']
+            else:
+                chain = self.ctx.chains.pop(k)
+                self.ctx.contexts[k] = chain + [node.outputs['context_patch']] if 'context_patch' in node.outputs else chain
@@ -0,0 +1,93 @@
+from contextlib import contextmanager, nullcontext
+import time
+
+from aiida.engine import WorkChain
+
+# Extra of the workchain node holding its timings.
+TIMINGS_EXTRA = 'aiida_tools_timings'
+
+
+class StepTimings:
+    """
+    Time spent by a workchain in each phase of its steps, e.g. converting inputs
+    or waiting for a child process. Stored as the extra `aiida_tools_timings` of
+    its node, in the form
+    {'label': <label of the chain>, 'steps': {<step>: {'label': <label of the step>, <phase>: seconds}}}.
+    Repeated phases of a step, e.g. inside a loop, are added up.
+    """
+    def __init__(self, node):
+        self.node = node
+        self.data = node.base.extras.get(TIMINGS_EXTRA, {'label': '', 'steps': {}})
+
+    def step(self, step):
+        return self.data['steps'].setdefault(str(step), {})
+
+    def add(self, step, phase, seconds):
+        entry = self.step(step)
+        entry[phase] = round(entry.get(phase, 0.0) + seconds, 6)
+
+    @contextmanager
+    def phase(self, step, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(step, phase, time.perf_counter() - start)
+
+    def save(self):
+        self.node.base.extras.set(TIMINGS_EXTRA, self.data)
+
+
+class TimedWorkChain(WorkChain):
+    """
+    A WorkChain that records the timings of its steps in a `StepTimings` when
+    launched with `record_timings=True`. The timings are written to the node
+    every time the workchain starts waiting for child processes, and when it
+    terminates.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.input('record_timings', valid_type=bool, non_db=True, default=False,
+                   help='Record the time spent in each phase of the steps in the `aiida_tools_timings` extra.')
+
+    @property
+    def timings(self):
+        """The `StepTimings` of this workchain, or None if they are not recorded."""
+        if not self.inputs['record_timings']:
+            return None
+        if getattr(self, '_timings', None) is None:
+            self._timings = StepTimings(self.node)
+        return self._timings
+
+    def timed(self, step, phase):
+        """A context manager adding the time spent inside it to `phase` of `step`."""
+        return nullcontext() if self.timings is None else self.timings.phase(step, phase)
+
+    def label_timings(self, label, step=None):
+        """Sets the label of `step`, or of the whole chain."""
+        if self.timings is None:
+            return
+        if step is None:
+            self.timings.data['label'] = label
+        else:
+            self.timings.step(step)['label'] = label
+
+    def start_waiting(self, *steps):
+        """Marks `steps` as waiting for child processes from now on, and writes the timings so far to the node."""
+        if self.timings is not None:
+            self.ctx.waiting_since = {str(s): time.time() for s in steps}
+            self.timings.save()
+
+    def stop_waiting(self):
+        """Adds the time since `start_waiting` to the `wait` phase of the waiting steps."""
+        if self.timings is not None:
+            now = time.time()
+            for step, since in self.ctx.pop('waiting_since', {}).items():
+                self.timings.add(step, 'wait', now - since)
+
+    def on_terminated(self):
+        super().on_terminated()
+        if self.timings is not None:
+            self.timings.save()
@@ -0,0 +1,55 @@
+"""
+Runs all the benchmarks, or those given with --only, and appends their results
+to a json lines file, one document per benchmark, so that they can be compared
+between revisions. Benchmarks that fail are recorded with their error.
+
+    python -m benchmarks --output results.jsonl
+    python -m benchmarks --quick --only chain_overhead while_loop
+"""
+import argparse
+import importlib
+import json
+import sys
+import time
+import traceback
+
+# Benchmark module: (arguments of a full run, arguments of a quick run)
+SUITE = {
+    'chain_overhead': ([], ['--steps', '10', '100', '1000', '--run-max-steps', '10']),
+    'while_loop': ([], ['--iterations', '10']),
+    'checkpoint_size': ([], ['--steps', '5', '--blob', '10000']),
+    'structure_conversion': ([], ['--sizes', '10', '1000', '--repeat', '1']),
+    'pseudo_conversion': ([], ['--elements', '1', '10', '--repeat', '1']),
+    'script_overhead': ([], ['--scripts', '2']),
+    'array_results': ([], ['--sizes', '100000']),
+    'worker_throughput': ([], ['--chains', '5', '--steps', '2']),
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='benchmark_results.jsonl', help='Append the results to this file.')
+    parser.add_argument('--only', nargs='+', choices=list(SUITE), help='Only run these benchmarks.')
+    parser.add_argument('--quick', action='store_true', help='Run smaller versions of the benchmarks.')
+    args = parser.parse_args(argv)
+
+    failed = []
+    for name in args.only or SUITE:
+        full, quick = SUITE[name]
+        try:
+            module = importlib.import_module(f'.{name}', __package__)
+            module.main((quick if args.quick else full) + ['--output', args.output])
+        except Exception:
+            failed.append(name)
+            error = traceback.format_exc()
+            sys.stderr.write(error)
+            with open(args.output, 'a') as f:
+                f.write(json.dumps({'benchmark': name, 'time': time.time(), 'error': error}) + '\n')
+
+    if failed:
+        sys.stderr.write(f"Failed benchmarks: {', '.join(failed)}\n")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,86 @@
+"""
+Compares the two ways a Script can return an array of floats: as a list in its
+json results file, parsed into a Dict, or as a .npy file, parsed into an
+ArrayData. Reports the time of parsing, of loading the stored array back and of
+summing it through a memory map of the stored .npy file, or the peak Python
+memory with --trace-memory (this makes the timings meaningless).
+
+    python -m benchmarks.array_results --sizes 1000000 10000000
+"""
+import argparse
+import json
+import os
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+from aiida import orm
+from aiida_tools.calculations.script import mmap_array, parse_arrays
+
+from .common import load_temporary_profile, report, timer
+
+
+def measure(results, key, function, trace_memory=False):
+    """
+    Times `function` into `results[key + '_seconds']`, or records its peak
+    traced memory in `results[key + '_peak_bytes']`. Returns its result.
+    """
+    if not trace_memory:
+        with timer(results, key + '_seconds'):
+            return function()
+
+    tracemalloc.start()
+    try:
+        value = function()
+        results[key + '_peak_bytes'] = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return value
+
+
+def parse_json(path):
+    with open(path) as handle:
+        return orm.Dict(dict=json.load(handle)).store()
+
+
+def run(size, trace_memory=False):
+    data = np.random.default_rng(0).random(size)
+    results = {'size': size}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        json_path = os.path.join(tmp, 'script_results.json')
+        with open(json_path, 'w') as handle:
+            json.dump({'x': data.tolist()}, handle)
+        np.save(os.path.join(tmp, 'script_results.npy'), data)
+        results['json_file_bytes'] = os.path.getsize(json_path)
+        results['npy_file_bytes'] = os.path.getsize(os.path.join(tmp, 'script_results.npy'))
+
+        d = measure(results, 'json_parse', lambda: parse_json(json_path), trace_memory)
+        a = measure(results, 'npy_parse', lambda: parse_arrays(tmp, 'script_results').store(), trace_memory)
+
+    measure(results, 'json_load', lambda: np.asarray(orm.load_node(d.pk).get_dict()['x']), trace_memory)
+    loaded = measure(results, 'npy_load', lambda: orm.load_node(a.pk).get_array('results'), trace_memory)
+    assert np.array_equal(loaded, data)
+
+    def mmap_sum():
+        with mmap_array(orm.load_node(a.pk)) as array:
+            return float(array.sum())
+
+    assert measure(results, 'npy_mmap_sum', mmap_sum, trace_memory) == float(data.sum())
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000000])
+    parser.add_argument('--trace-memory', action='store_true', help='Measure the peak memory instead of the time.')
+    parser.add_argument('--output', help='Append the results to this file.')
+    args = parser.parse_args(argv)
+
+    load_temporary_profile()
+    return report('array_results', [run(size, args.trace_memory) for size in args.sizes], args.output)
+
+
+if __name__ == '__main__':
+    main()
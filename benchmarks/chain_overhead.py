@@ -0,0 +1,93 @@
+"""
+Measures the time a DeclarativeChain spends per step on top of running its
+processes: a chain of trivial workfunction steps is compared with running the
+same workfunctions directly. Also reports how compiling the specification scales
+with the number of steps, for all sizes, while chains are only run up to
+--run-max-steps steps.
+
+    python -m benchmarks.chain_overhead --steps 10 100 1000 --run-max-steps 100
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from aiida import orm, engine
+from aiida.plugins import WorkflowFactory
+from aiida_tools.workflows.declarative_chain import DeclarativeChain, compile_specification, parse_specification
+
+from .common import load_temporary_profile, report
+
+
+def make_specification(steps):
+    """A chain of `steps` workfunction steps, each using the result of the previous one."""
+    step = (
+        "- workflow: core.arithmetic.add_multiply\n"
+        "  inputs:\n"
+        "    x: \"{{ ctx.count }}\"\n"
+        "    y: 1\n"
+        "    z: 1\n"
+        "  postprocess:\n"
+        "  - \"{{ ctx.current.outputs.result.value | to_ctx('count') }}\"\n"
+    )
+    return "setup:\n- \"{{ 0 | to_ctx('count') }}\"\nsteps:\n" + step * steps
+
+
+def run_directly(steps):
+    """Runs the processes of the chain without it, returns the time it took."""
+    add_multiply = WorkflowFactory('core.arithmetic.add_multiply')
+    count = 0
+    start = time.perf_counter()
+    for _ in range(steps):
+        count = add_multiply(orm.Int(count), orm.Int(1), orm.Int(1)).value
+    return time.perf_counter() - start
+
+
+def run_chain(content):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'workflow.yaml')
+        with open(path, 'w') as f:
+            f.write(content)
+        start = time.perf_counter()
+        _, node = engine.run_get_node(DeclarativeChain, workchain_specification=orm.SinglefileData(path))
+        total = time.perf_counter() - start
+
+    assert node.is_finished_ok, node.exit_status
+    return total
+
+
+def run(steps, run_max_steps):
+    content = make_specification(steps)
+    start = time.perf_counter()
+    compile_specification(parse_specification(content.encode(), '.yaml'))
+    result = {
+        'steps': steps,
+        'specification_bytes': len(content),
+        'compile_seconds': time.perf_counter() - start,
+    }
+    if steps > run_max_steps:
+        return result
+
+    chain = run_chain(content)
+    direct = run_directly(steps)
+    result.update({
+        'chain_seconds': chain,
+        'direct_seconds': direct,
+        'overhead_seconds_per_step': (chain - direct) / steps,
+    })
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--steps', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--run-max-steps', type=int, default=100, help='Only compile the specification of longer chains.')
+    parser.add_argument('--output', help='Append the results to this file.')
+    args = parser.parse_args(argv)
+
+    load_temporary_profile()
+    return report('chain_overhead', [run(steps, args.run_max_steps) for steps in args.steps], args.output)
+
+
+if __name__ == '__main__':
+    main()
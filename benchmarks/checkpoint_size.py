@@ -0,0 +1,89 @@
+"""
+Measures the size of the checkpoints of a DeclarativeChain and the time it takes
+to serialise them, with and without `compact_checkpoints`.
+
+    python -m benchmarks.checkpoint_size --steps 20 --blob 100000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from aiida.orm.utils.serialize import serialize
+from plumpy.persistence import Bundle
+
+from aiida import orm, engine
+from aiida_tools.workflows.declarative_chain import DeclarativeChain
+
+from .common import load_temporary_profile, report
+
+
+def make_specification(steps, blob):
+    """A chain of `steps` trivial steps that all inline a `blob` sized string through a reference."""
+    step = (
+        "- workflow: core.arithmetic.add_multiply\n"
+        "  inputs:\n"
+        "    x: {type: core.int, value: \"{{ ctx.count }}\"}\n"
+        "    y: {type: core.int, value: 1}\n"
+        "    z: {type: core.int, value: 1}\n"
+        "    metadata:\n"
+        "      description:\n"
+        "        \"$ref\": \"#/data/blob\"\n"
+        "  postprocess:\n"
+        "  - \"{{ (ctx.count + 1) | to_ctx('count') }}\"\n"
+    )
+    return f"data:\n  blob: {'x' * blob}\nsetup:\n- \"{{{{ 0 | to_ctx('count') }}}}\"\nsteps:\n" + step * steps
+
+
+class MeasuredChain(DeclarativeChain):
+    """Serialises a checkpoint after every step, like the daemon would, and records its size."""
+
+    measurements = []
+
+    def process_current(self):
+        exit_code = super().process_current()
+        start = time.perf_counter()
+        checkpoint = serialize(Bundle(self))
+        self.measurements.append({'bytes': len(checkpoint), 'serialize_seconds': time.perf_counter() - start})
+        return exit_code
+
+
+def run(steps, blob, compact):
+    measurements = MeasuredChain.measurements
+    measurements.clear()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'workflow.yaml')
+        with open(path, 'w') as f:
+            f.write(make_specification(steps, blob))
+
+        start = time.perf_counter()
+        _, node = engine.run_get_node(MeasuredChain, workchain_specification=orm.SinglefileData(path), compact_checkpoints=compact)
+        total = time.perf_counter() - start
+
+    assert node.is_finished_ok, node.exit_status
+    return {
+        'steps': steps,
+        'blob': blob,
+        'compact_checkpoints': compact,
+        'seconds_per_step': total / steps,
+        'mean_checkpoint_bytes': sum(m['bytes'] for m in measurements) / len(measurements),
+        'max_checkpoint_bytes': max(m['bytes'] for m in measurements),
+        'mean_serialize_seconds': sum(m['serialize_seconds'] for m in measurements) / len(measurements),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--steps', type=int, default=20)
+    parser.add_argument('--blob', type=int, default=100000, help='Size in bytes of the data inlined in every step.')
+    parser.add_argument('--output', help='Append the results to this file.')
+    args = parser.parse_args(argv)
+
+    load_temporary_profile()
+    results = [run(args.steps, args.blob, compact) for compact in (False, True)]
+    return report('checkpoint_size', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
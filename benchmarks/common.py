@@ -0,0 +1,64 @@
+"""
+Helpers shared by the benchmarks. These run against a temporary, in-memory
+AiiDA profile so they need neither a database server, a broker nor a daemon.
+"""
+import json
+import platform
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+from aiida import load_profile, orm, __version__ as aiida_version
+from aiida.storage.sqlite_temp import SqliteTempBackend
+
+
+def load_temporary_profile():
+    profile = SqliteTempBackend.create_profile('aiida-tools-benchmarks', options={'warnings.development_version': False})
+    load_profile(profile, allow_switch=True)
+    return profile
+
+
+def local_code():
+    """
+    A code running the current python interpreter on a computer that executes
+    jobs directly on this machine, in a temporary working directory. Commands
+    are not run in a login shell, whose startup would dominate the timings.
+    """
+    computer = orm.Computer(
+        label='localhost', hostname='localhost', transport_type='core.local',
+        scheduler_type='core.direct', workdir=tempfile.mkdtemp()
+    ).store()
+    computer.configure(safe_interval=0.0, use_login_shell=False)
+    computer.set_minimum_job_poll_interval(0.0)
+    return orm.Code(remote_computer_exec=(computer, sys.executable)).store()
+
+
+@contextmanager
+def timer(results, key):
+    """Adds the wall time spent inside the block to `results[key]`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        results[key] = results.get(key, 0.0) + time.perf_counter() - start
+
+
+def report(name, results, output=None):
+    """
+    Prints the results of a benchmark as a json document. If `output` is given
+    the document is also appended to that file as a single json line.
+    """
+    document = {
+        'benchmark': name,
+        'time': time.time(),
+        'python': platform.python_version(),
+        'aiida': aiida_version,
+        'results': results
+    }
+    json.dump(document, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    if output is not None:
+        with open(output, 'a') as f:
+            f.write(json.dumps(document) + '\n')
+    return document
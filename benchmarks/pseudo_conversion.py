@@ -0,0 +1,75 @@
+"""
+Measures the time it takes to resolve the `{group, element}` descriptions of
+pseudopotentials of `elements` different elements, one query per element as
+`dict2upf` does on its own, or prefetched together as a DeclarativeChain does
+for all the pseudopotentials of a step.
+
+    python -m benchmarks.pseudo_conversion --elements 1 10 50
+"""
+import argparse
+import io
+import time
+
+from aiida import orm
+from aiida_pseudo.data.pseudo.upf import UpfData
+
+from aiida_tools.workflows.declarative_chain import PseudoResolver, dict2upf, prefetch_pseudos
+
+from .common import load_temporary_profile, report
+
+ELEMENTS = [
+    'H', 'He', 'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne', 'Na', 'Mg', 'Al', 'Si', 'P', 'S', 'Cl', 'Ar', 'K', 'Ca',
+    'Sc', 'Ti', 'V', 'Cr', 'Mn', 'Fe', 'Co', 'Ni', 'Cu', 'Zn', 'Ga', 'Ge', 'As', 'Se', 'Br', 'Kr', 'Rb', 'Sr', 'Y',
+    'Zr', 'Nb', 'Mo', 'Tc', 'Ru', 'Rh', 'Pd', 'Ag', 'Cd', 'In', 'Sn', 'Sb', 'Te', 'I', 'Xe', 'Cs', 'Ba',
+]
+
+
+def make_family(label):
+    """A group holding a minimal stand-in UpfData for every element in ELEMENTS."""
+    group = orm.Group(label=label).store()
+    pseudos = []
+    for element in ELEMENTS:
+        content = f'<UPF version="2.0.1">\n<PP_HEADER element="{element}" z_valence="1.0"/>\n</UPF>\n'
+        pseudos.append(UpfData(io.BytesIO(content.encode()), filename=f'{element}.upf').store())
+    group.add_nodes(pseudos)
+    return group
+
+
+def measure(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def prefetched(specs):
+    pseudos = PseudoResolver()
+    prefetch_pseudos(specs, pseudos)
+    return [dict2upf(d, pseudos) for d in specs]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--elements', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='Append the results to this file.')
+    args = parser.parse_args(argv)
+
+    load_temporary_profile()
+    group = make_family('benchmark_pseudos')
+    results = []
+    for n in args.elements:
+        specs = [{'group': group.label, 'element': e} for e in ELEMENTS[:n]]
+        results.append({
+            'elements': len(specs),
+            'per_element_seconds': measure(lambda: [dict2upf(d) for d in specs], args.repeat),
+            'prefetched_seconds': measure(lambda: prefetched(specs), args.repeat),
+        })
+
+    return report('pseudo_conversion', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
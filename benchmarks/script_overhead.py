@@ -0,0 +1,99 @@
+"""
+Measures the time it takes to run a trivial python script as a Script
+calculation and as the steps of a ScriptChain, on a local computer without a
+scheduler, compared with running the script directly.
+
+    python -m benchmarks.script_overhead --scripts 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from aiida import orm
+from aiida.manage import get_manager
+from aiida_tools.calculations.script import Script
+from aiida_tools.workflows.script_chain import ScriptChain
+
+from .common import load_temporary_profile, local_code, report
+
+SCRIPT = """import json, sys
+parameters, context, results = sys.argv[1:4]
+with open(context) as f:
+    ctx = json.load(f)
+ctx['count'] = ctx.get('count', 0) + 1
+with open(context, 'w') as f:
+    json.dump(ctx, f)
+with open(results, 'w') as f:
+    json.dump({'count': ctx['count']}, f)
+"""
+
+OPTIONS = {'resources': {'num_machines': 1, 'num_mpiprocs_per_machine': 1}}
+
+
+def run_directly(path, scripts):
+    """Runs the script `scripts` times in a row, returns the time it took."""
+    with tempfile.TemporaryDirectory() as tmp:
+        files = [os.path.join(tmp, name) for name in ('parameters.json', 'context.json', 'results.json')]
+        for f in files[:2]:
+            with open(f, 'w') as handle:
+                json.dump({}, handle)
+        start = time.perf_counter()
+        for _ in range(scripts):
+            subprocess.run([sys.executable, path, *files], check=True)
+        return time.perf_counter() - start
+
+
+def run(scripts, code, path, poll_interval):
+    # Without a broker, the chain learns that a submitted script finished by polling it
+    runner = get_manager().create_runner(poll_interval=poll_interval)
+    script = orm.SinglefileData(path).store()
+
+    start = time.perf_counter()
+    _, node = runner.run_get_node(Script, script=script, parameters=orm.Dict(), context=orm.Dict(), code=code, metadata={'options': OPTIONS})
+    single = time.perf_counter() - start
+    assert node.is_finished_ok, node.exit_status
+
+    start = time.perf_counter()
+    _, node = runner.run_get_node(
+        ScriptChain,
+        scripts={f'{i}': script for i in range(scripts)},
+        parameters={f'{i}': orm.Dict() for i in range(scripts)},
+        script={'code': code, 'metadata': {'options': OPTIONS}}
+    )
+    chain = time.perf_counter() - start
+    assert node.is_finished_ok, node.exit_status
+    assert node.outputs.results[f'{scripts - 1}']['count'] == scripts
+
+    direct = run_directly(path, scripts)
+    return {
+        'scripts': scripts,
+        'script_seconds': single,
+        'chain_seconds': chain,
+        'direct_seconds': direct,
+        'chain_overhead_seconds_per_script': (chain - direct) / scripts,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scripts', type=int, nargs='+', default=[5])
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='Interval in seconds at which the chain polls its scripts.')
+    parser.add_argument('--output', help='Append the results to this file.')
+    args = parser.parse_args(argv)
+
+    load_temporary_profile()
+    code = local_code()
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'count.py')
+        with open(path, 'w') as f:
+            f.write(SCRIPT)
+        results = [run(n, code, path, args.poll_interval) for n in args.scripts]
+    return report('script_overhead', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
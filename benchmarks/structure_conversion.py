@@ -0,0 +1,75 @@
+"""
+Measures the time it takes to turn the declarative description of a structure
+into a StructureData, for the list of `atoms` and the `symbols`/`positions`
+array forms, and compares it with validating the full json schema and calling
+`append_atom` for every atom.
+
+    python -m benchmarks.structure_conversion --sizes 10 1000 10000
+"""
+import argparse
+import time
+
+import numpy as np
+from aiida import orm
+from jsonschema import validate
+
+from aiida_tools.workflows.declarative_chain import dict2structure, structschema
+
+from .common import load_temporary_profile, report
+
+
+def append_atoms(d):
+    """The reference implementation, one atom at a time."""
+    validate(instance=d, schema=structschema)
+    structure = orm.StructureData(cell=d['cell'])
+    for a in d['atoms']:
+        structure.append_atom(**a)
+    return structure
+
+
+def make_structure(n, seed=0):
+    rng = np.random.default_rng(seed)
+    side = max(n, 1) ** (1 / 3) * 2.5
+    positions = rng.random((n, 3)) * side
+    symbols = rng.choice(['Ni', 'O', 'Fe', 'Mn'], size=n)
+    cell = (np.eye(3) * side).tolist()
+    atoms = [{'symbols': str(s), 'position': p} for s, p in zip(symbols, positions.tolist())]
+    return {'cell': cell, 'atoms': atoms}, {'cell': cell, 'symbols': symbols, 'positions': positions}
+
+
+def measure(fn, d, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(d)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--reference-max-atoms', type=int, default=10000,
+                        help='Skip the reference implementation for larger structures.')
+    parser.add_argument('--output', help='Append the results to this file.')
+    args = parser.parse_args(argv)
+
+    load_temporary_profile()
+    results = []
+    for n in args.sizes:
+        atoms, arrays = make_structure(n)
+        result = {
+            'atoms': n,
+            'atoms_list_seconds': measure(dict2structure, atoms, args.repeat),
+            'arrays_seconds': measure(dict2structure, arrays, args.repeat),
+        }
+        if n <= args.reference_max_atoms:
+            result['append_atom_seconds'] = measure(append_atoms, atoms, args.repeat)
+        results.append(result)
+
+    return report('structure_conversion', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
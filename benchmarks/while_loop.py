@@ -0,0 +1,76 @@
+"""
+Measures the cost of an iteration of a `while` loop in a DeclarativeChain, by
+comparing a loop running a trivial workfunction step `iterations` times with a
+chain in which the same step is written out `iterations` times.
+
+    python -m benchmarks.while_loop --iterations 10 50
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from aiida import orm, engine
+from aiida_tools.workflows.declarative_chain import DeclarativeChain
+
+from .common import load_temporary_profile, report
+
+STEP = (
+    "- workflow: core.arithmetic.add_multiply\n"
+    "  inputs:\n"
+    "    x: \"{{ ctx.count }}\"\n"
+    "    y: 1\n"
+    "    z: 1\n"
+    "  postprocess:\n"
+    "  - \"{{ ctx.current.outputs.result.value | to_ctx('count') }}\"\n"
+)
+
+SETUP = "setup:\n- \"{{ 0 | to_ctx('count') }}\"\nsteps:\n"
+
+
+def make_loop(iterations):
+    body = ''.join('    ' + line + '\n' for line in STEP.splitlines())
+    return SETUP + f"- while: \"{{{{ ctx.count < {iterations} }}}}\"\n  steps:\n" + body
+
+
+def make_unrolled(iterations):
+    return SETUP + STEP * iterations
+
+
+def run_chain(content):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'workflow.yaml')
+        with open(path, 'w') as f:
+            f.write(content)
+        start = time.perf_counter()
+        _, node = engine.run_get_node(DeclarativeChain, workchain_specification=orm.SinglefileData(path))
+        total = time.perf_counter() - start
+
+    assert node.is_finished_ok, node.exit_status
+    return total
+
+
+def run(iterations):
+    loop = run_chain(make_loop(iterations))
+    unrolled = run_chain(make_unrolled(iterations))
+    return {
+        'iterations': iterations,
+        'loop_seconds': loop,
+        'unrolled_seconds': unrolled,
+        'seconds_per_iteration': loop / iterations,
+        'loop_overhead_seconds_per_iteration': (loop - unrolled) / iterations,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, nargs='+', default=[10, 50])
+    parser.add_argument('--output', help='Append the results to this file.')
+    args = parser.parse_args(argv)
+
+    load_temporary_profile()
+    return report('while_loop', [run(n) for n in args.iterations], args.output)
+
+
+if __name__ == '__main__':
+    main()
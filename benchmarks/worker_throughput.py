@@ -0,0 +1,90 @@
+"""
+Runs many DeclarativeChains concurrently on a single event loop, like a daemon
+worker does, with process function steps run inline or submitted. Reports the
+throughput and the longest time the event loop was blocked. Submitted functions
+run on the same event loop here, so both modes block it about as long; the
+difference only shows with several daemon workers sharing the functions.
+
+    python -m benchmarks.worker_throughput --chains 20 --steps 5
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from aiida import orm
+from aiida.manage import get_manager
+from aiida_tools.workflows.declarative_chain import DeclarativeChain
+
+from .common import load_temporary_profile, report
+
+
+def make_specification(steps, mode):
+    """A chain of `steps` workfunction steps, each using the result of the previous one."""
+    step = (
+        "- workflow: core.arithmetic.add_multiply\n"
+        "  inputs:\n"
+        "    x: \"{{ ctx.count }}\"\n"
+        "    y: 1\n"
+        "    z: 1\n"
+        "  postprocess:\n"
+        "  - \"{{ ctx.current.outputs.result.value | to_ctx('count') }}\"\n"
+    )
+    return f"process_functions: {mode}\nsetup:\n- \"{{{{ 0 | to_ctx('count') }}}}\"\nsteps:\n" + step * steps
+
+
+async def monitor(nodes, interval):
+    """Ticks every `interval` seconds until all `nodes` are terminated, returns the longest delay of a tick."""
+    lag = 0.0
+    last = time.perf_counter()
+    while not all(node.is_terminated for node in nodes):
+        await asyncio.sleep(interval)
+        now = time.perf_counter()
+        lag = max(lag, now - last - interval)
+        last = now
+    return lag
+
+
+def run(chains, steps, mode, interval, poll_interval):
+    # Without a broker, a chain learns that a submitted process finished by polling it
+    runner = get_manager().create_runner(poll_interval=poll_interval)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'workflow.yaml')
+        with open(path, 'w') as f:
+            f.write(make_specification(steps, mode))
+        specification = orm.SinglefileData(path).store()
+
+        start = time.perf_counter()
+        nodes = [runner.submit(DeclarativeChain, workchain_specification=specification) for _ in range(chains)]
+        lag = runner.loop.run_until_complete(monitor(nodes, interval))
+        total = time.perf_counter() - start
+
+    assert all(node.is_finished_ok for node in nodes), [node.exit_status for node in nodes]
+    return {
+        'chains': chains,
+        'steps': steps,
+        'process_functions': mode,
+        'seconds': total,
+        'steps_per_second': chains * steps / total,
+        'max_loop_lag_seconds': lag,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chains', type=int, default=20)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--interval', type=float, default=0.01, help='Interval in seconds of the event loop probe.')
+    parser.add_argument('--poll-interval', type=float, default=0.05, help='Interval in seconds at which chains poll submitted processes.')
+    parser.add_argument('--output', help='Append the results to this file.')
+    args = parser.parse_args(argv)
+
+    load_temporary_profile()
+    results = [run(args.chains, args.steps, mode, args.interval, args.poll_interval) for mode in ('inline', 'submit')]
+    return report('worker_throughput', results, args.output)
+
+
+if __name__ == '__main__':
+    main()
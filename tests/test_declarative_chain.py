@@ -0,0 +1,82 @@
+import pytest
+from aiida.engine import WorkChain
+from aiida.orm import Dict, Int
+from aiida.plugins import CalculationFactory
+
+from aiida_tools.workflows.declarative_chain import flatten_inputs, freeze, input_plan
+
+
+class Inputs(WorkChain):
+    @classmethod
+    def define(cls, spec):
+        super().define(spec)
+        spec.input('parameters', valid_type=Dict)
+        spec.input_namespace('sub')
+        spec.input('sub.x', valid_type=Int)
+        spec.input_namespace('extra', valid_type=Int, dynamic=True)
+        spec.input('flag', valid_type=bool, non_db=True, required=False)
+
+
+def test_flatten_inputs():
+    inputs = {
+        'a': {'b': 1, 'c': {'d': 2}},
+        'typed': {'type': 'core.dict', 'value': {'x': 1}},
+        'ref': {'node': 12},
+        'empty': {},
+    }
+    assert flatten_inputs(inputs) == {
+        'a.b': 1, 'a.c.d': 2, 'typed': {'type': 'core.dict', 'value': {'x': 1}}, 'ref': {'node': 12}, 'empty': {},
+    }
+
+
+def test_split():
+    plan = input_plan(Inputs)
+    assert plan.split('parameters') == (('parameters',), ())
+    assert plan.split('parameters.CONTROL.calculation') == (('parameters',), ('CONTROL', 'calculation'))
+    assert plan.split('sub.x') == (('sub', 'x'), ())
+    assert plan.split('extra.anything') == (('extra', 'anything'), ())
+    assert plan.split('metadata.call_link_label') == (('metadata', 'call_link_label'), ())
+    for key in ('missing', 'sub.y'):
+        with pytest.raises(ValueError):
+            plan.split(key)
+
+
+def test_convert():
+    plan = input_plan(Inputs)
+    # Ports that do not take nodes are passed as is
+    assert plan.convert(('flag',), True) is True
+    options = {'options': {'max_wallclock_seconds': 60}}
+    assert plan.convert(('metadata',), options) is options
+    with pytest.raises(TypeError):
+        plan.convert(('sub',), 5)
+    with pytest.raises(ValueError):
+        plan.convert(('sub',), {'y': 1})
+
+
+def test_raw_values():
+    plan = input_plan(Inputs)
+    step_inputs = {
+        'parameters': {'CONTROL': {'a': 1}},
+        'parameters.CONTROL.b': "{{ b }}",
+        'sub.x': {'type': 'core.int', 'value': 3},
+    }
+    values, types = plan.raw_values(step_inputs, lambda val: 2)
+    assert values == {('parameters',): {'CONTROL': {'a': 1, 'b': 2}}, ('sub', 'x'): 3}
+    assert types == {('parameters',): None, ('sub', 'x'): Int}
+    assert step_inputs['parameters'] == {'CONTROL': {'a': 1}}
+
+    with pytest.raises(TypeError):
+        plan.raw_values({'flag': True, 'flag.a': 1}, str)
+
+
+def test_retry_inputs_do_not_change_the_step():
+    # The metadata namespace is not converted, so the retry inputs are set inside its raw value
+    plan = input_plan(CalculationFactory('core.arithmetic.add'))
+    step_inputs = {'metadata': {'options': {'max_wallclock_seconds': 60, 'resources': {'num_machines': 1}}}}
+    retry = flatten_inputs({'metadata': {'options': {'max_wallclock_seconds': 999}}})
+
+    for stored in (step_inputs, freeze(step_inputs)):
+        values, types = plan.raw_values({**stored, **retry}, str)
+        inputs = plan.inputs(values, types)
+        assert inputs['metadata']['options'] == {'max_wallclock_seconds': 999, 'resources': {'num_machines': 1}}
+    assert step_inputs['metadata']['options']['max_wallclock_seconds'] == 60
@@ -0,0 +1,166 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from aiida_tools.utils import RefCache
+
+
+class Documents(BaseHTTPRequestHandler):
+    """Serves `server.documents`, path -> (status, body), and counts the requests."""
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        status, body = self.server.documents.get(self.path, (404, b'not found'))
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        # Keeps the http cache of the session out of the way
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Documents)
+    server.documents = {}
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f'http://127.0.0.1:{server.server_address[1]}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def age(cache, uri, seconds):
+    """Makes the cached entry of `uri` look `seconds` older, both as fetched and as used."""
+    _, meta_path = cache._paths(uri)
+    meta = json.loads(meta_path.read_text())
+    meta['fetched'] -= seconds
+    meta_path.write_text(json.dumps(meta))
+    t = time.time() - seconds
+    os.utime(meta_path, (t, t))
+
+
+def test_remote_documents_are_cached_on_disk(server, tmp_path):
+    server.documents['/a.json'] = (200, b'{"a": 1}')
+    uri = f'{server.url}/a.json'
+
+    assert RefCache(tmp_path).load(uri) == {'a': 1}
+    # A new cache, e.g. after a restart of the daemon, reads the entry from disk
+    assert RefCache(tmp_path).load(uri) == {'a': 1}
+    assert server.requests == ['/a.json']
+
+
+def test_expired_entries_are_refreshed(server, tmp_path):
+    uri = f'{server.url}/a.yaml'
+    server.documents['/a.yaml'] = (200, b'a: 1')
+    cache = RefCache(tmp_path, max_age=60)
+    assert cache.load(uri) == {'a': 1}
+
+    server.documents['/a.yaml'] = (200, b'a: 2')
+    assert cache.load(uri) == {'a': 1}
+    age(cache, uri, 120)
+    assert cache.load(uri) == {'a': 2}
+    assert len(server.requests) == 2
+
+
+def test_stale_entries_are_used_when_the_request_fails(server, tmp_path):
+    uri = f'{server.url}/a.json'
+    server.documents['/a.json'] = (200, b'{"a": 1}')
+    cache = RefCache(tmp_path, max_age=0)
+    assert cache.get(uri) == b'{"a": 1}'
+
+    server.documents['/a.json'] = (500, b'error')
+    assert cache.get(uri) == b'{"a": 1}'
+    assert len(server.requests) == 2
+
+    with pytest.raises(requests.HTTPError):
+        cache.get(f'{server.url}/missing.json')
+
+
+def test_stale_entries_are_used_when_the_server_is_down(server, tmp_path):
+    uri = f'{server.url}/a.json'
+    server.documents['/a.json'] = (200, b'{"a": 1}')
+    cache = RefCache(tmp_path, max_age=0)
+    cache.get(uri)
+
+    server.shutdown()
+    server.server_close()
+    assert cache.get(uri) == b'{"a": 1}'
+
+
+def test_offline(server, tmp_path):
+    uri = f'{server.url}/a.json'
+    server.documents['/a.json'] = (200, b'{"a": 1}')
+    RefCache(tmp_path).get(uri)
+
+    cache = RefCache(tmp_path, max_age=0, offline=True)
+    # Entries are used however old they are
+    assert cache.get(uri) == b'{"a": 1}'
+    with pytest.raises(LookupError):
+        cache.get(f'{server.url}/b.json')
+    assert server.requests == ['/a.json']
+
+
+def test_offline_from_environment(monkeypatch, tmp_path):
+    monkeypatch.setenv('AIIDA_TOOLS_OFFLINE', '1')
+    monkeypatch.setenv('AIIDA_TOOLS_REF_CACHE_DIR', str(tmp_path))
+    cache = RefCache()
+    assert cache.offline
+    assert cache.directory == tmp_path
+
+
+def test_entries_with_a_wrong_hash_are_discarded(server, tmp_path):
+    uri = f'{server.url}/a.json'
+    server.documents['/a.json'] = (200, b'{"a": 1}')
+    cache = RefCache(tmp_path)
+    cache.get(uri)
+
+    data_path, meta_path = cache._paths(uri)
+    data_path.write_bytes(b'{"a": 2}')
+    assert cache.read(uri) is None
+    assert not data_path.exists() and not meta_path.exists()
+
+    assert cache.load(uri) == {'a': 1}
+    assert len(server.requests) == 2
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = RefCache(tmp_path, max_size=10)
+    cache.write('http://a', b'aaaa')
+    cache.write('http://b', b'bbbb')
+    age(cache, 'http://a', 20)
+    age(cache, 'http://b', 10)
+
+    # Reading marks `a` as recently used, so `b` goes first
+    assert cache.read('http://a')[0] == b'aaaa'
+    cache.write('http://c', b'cccc')
+    assert cache.read('http://b') is None
+    assert cache.read('http://a')[0] == b'aaaa'
+    assert cache.read('http://c')[0] == b'cccc'
+
+
+def test_local_files(tmp_path):
+    path = tmp_path / 'doc.yaml'
+    path.write_text('a: 1')
+    uri = path.as_uri()
+    cache = RefCache(tmp_path / 'cache')
+    assert cache.load(uri) == {'a': 1}
+
+    # Local files are always read again
+    path.write_text('a: 2')
+    assert cache.load(uri) == {'a': 2}
+
+    # and the cached copy is used when they can no longer be read
+    path.unlink()
+    assert cache.load(uri) == {'a': 2}
+    with pytest.raises(OSError):
+        cache.get((tmp_path / 'missing.yaml').as_uri())
@@ -0,0 +1,127 @@
+from aiida_tools.workflows.scheduling import (
+    compile_program, early_results, result_writes, schedule_steps, step_references, template_references
+)
+
+
+def step(name, inputs=None, postprocess=None, **fields):
+    return {'calcjob': name, 'inputs': inputs or {}, 'postprocess': postprocess or [], **fields}
+
+
+def names(steps):
+    """The structure of scheduled steps, with every step replaced by its calcjob name."""
+    out = []
+    for s in steps:
+        if 'parallel' in s:
+            out.append([c['calcjob'] for c in s['parallel']])
+        elif 'while' in s:
+            out.append({'while': names(s['steps'])})
+        else:
+            out.append(s['calcjob'])
+    return out
+
+
+def test_template_references():
+    assert template_references("{{ ctx.a.b + ctx['c'] }}") == ({'a', 'c'}, set())
+    assert template_references("{{ ctx.a | to_ctx('b') | to_results('c') }}") == ({'a'}, {'b', 'results.c'})
+    # Keys that are not constants can not be analysed
+    assert template_references("{{ ctx[key] }}") is None
+    assert template_references("{{ 1 | to_ctx(key) }}") is None
+
+
+def test_step_references():
+    s = step('a', {'x': "{{ ctx.x }}", 'y': "{{ 1 | to_ctx('y') }}"}, ["{{ ctx.current.outputs.z | to_ctx('z') }}"],
+             retry={'inputs': {'w': "{{ ctx.w }}"}})
+    assert step_references(s) == ({'x', 'w'}, set(), {'y'}, {'z'})
+    assert step_references({'while': 'true', 'steps': []}) is None
+    assert step_references(step('a', {'x': "{{ ctx[k] }}"})) is None
+
+
+def test_independent_steps_run_together():
+    steps = [
+        step('a', postprocess=["{{ 1 | to_ctx('a') }}"]),
+        step('b', postprocess=["{{ 1 | to_ctx('b') }}"]),
+        step('c', {'x': "{{ ctx.a }}", 'y': "{{ ctx.b }}"}),
+    ]
+    assert names(schedule_steps(steps)) == [['a', 'b'], 'c']
+
+
+def test_max_concurrent_splits_waves():
+    steps = [step(n) for n in 'abcde']
+    assert names(schedule_steps(steps, max_concurrent=2)) == [['a', 'b'], ['c', 'd'], 'e']
+
+
+def test_launch_writes_wait_for_earlier_postprocessing():
+    steps = [
+        step('a', postprocess=["{{ ctx.k | to_results('seen') }}"]),
+        step('b', {'x': "{{ 5 | to_ctx('k') }}"}),
+    ]
+    assert names(schedule_steps(steps)) == ['a', 'b']
+
+
+def test_postprocess_writes_keep_their_order():
+    # Both write `k` while postprocessed, which happens in order inside a wave
+    steps = [
+        step('a', postprocess=["{{ 1 | to_ctx('k') }}"]),
+        step('b', postprocess=["{{ 2 | to_ctx('k') }}"]),
+        step('c', {'x': "{{ ctx.k }}"}),
+    ]
+    assert names(schedule_steps(steps)) == [['a', 'b'], 'c']
+
+
+def test_later_steps_do_not_move_before_earlier_ones():
+    steps = [
+        step('a', postprocess=["{{ 1 | to_ctx('a') }}"]),
+        step('b', {'x': "{{ ctx.a }}"}, ["{{ 1 | to_ctx('b') }}"]),
+        step('c', postprocess=["{{ ctx.b }}"]),
+    ]
+    assert names(schedule_steps(steps)) == ['a', ['b', 'c']]
+
+
+def test_barriers():
+    steps = [
+        step('a'),
+        step('b', {'x': "{{ ctx.current }}"}),
+        step('c'),
+        {'while': "{{ ctx.go }}", 'steps': [step('d'), step('e')]},
+        step('f'),
+    ]
+    assert names(schedule_steps(steps)) == ['a', 'b', 'c', {'while': [['d', 'e']]}, 'f']
+
+
+def test_compile_program():
+    steps = [
+        step('a', **{'if': "{{ ctx.x }}"}),
+        {'while': "{{ ctx.go }}", 'steps': [step('b'), step('c', **{'if': "{{ ctx.y }}"})]},
+        step('d'),
+    ]
+    program = compile_program(steps)
+    assert [i['op'] for i in program] == ['skip', 'run', 'while', 'run', 'skip', 'run', 'loop', 'run']
+    assert program[0]['target'] == 2
+    assert 'if' not in program[1]['step']
+    assert program[2]['end'] == 7
+    assert program[4]['target'] == 6
+    assert program[6]['start'] == 2
+
+
+def test_result_writes():
+    assert result_writes("{{ 1 | to_results('a') }}{{ 2 | to_results('b') }}") == ['a', 'b']
+    assert result_writes("{{ 1 | to_results(key) }}") == [None]
+
+
+def test_early_results():
+    setup = ["{{ 1 | to_results('setup') }}"]
+    steps = [
+        step('a', postprocess=["{{ 1 | to_results('once') }}", "{{ 1 | to_results('twice') }}"]),
+        step('b', postprocess=["{{ 1 | to_results('twice') }}", "{{ 1 | to_results('nested.a') }}"]),
+        step('c', postprocess=["{{ 1 | to_results('nested') }}"]),
+        {'while': "{{ ctx.go }}", 'steps': [step('d', postprocess=["{{ 1 | to_results('loop') }}"])]},
+        {'map': "{{ ctx.items }}", 'results': 'mapped',
+         'step': step('e', postprocess=["{{ 1 | to_results('instances') }}"])},
+        step('f', {'x': "{{ 1 | to_results('retried') }}"}, retry={}),
+    ]
+    assert early_results(setup, compile_program(steps)) == ['mapped', 'once', 'setup']
+
+
+def test_no_early_results_with_dynamic_keys():
+    steps = [step('a', postprocess=["{{ 1 | to_results('once') }}", "{{ 1 | to_results(key) }}"])]
+    assert early_results([], compile_program(steps)) == []
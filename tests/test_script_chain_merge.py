@@ -0,0 +1,70 @@
+import pytest
+
+from aiida_tools.calculations.script import apply_context_patch, context_patch, patched_context
+from aiida_tools.workflows.script_chain import merge_context_dicts, merge_patch_chains
+
+
+class Node:
+    """Stands in for a stored Dict, the merging only needs its uuid and content."""
+    def __init__(self, uuid, content):
+        self.uuid = uuid
+        self.content = content
+
+    def get_dict(self):
+        return dict(self.content)
+
+
+def patch(uuid, set=None, unset=None):
+    return Node(uuid, {'set': set or {}, 'unset': unset or []})
+
+
+def test_context_patch_roundtrip():
+    before = {'a': 1, 'b': 2, 'c': 3}
+    after = {'a': 1, 'b': 5, 'd': 4}
+    p = context_patch(before, after)
+    assert p == {'set': {'b': 5, 'd': 4}, 'unset': ['c']}
+    assert apply_context_patch(dict(before), p) == after
+    assert context_patch(before, dict(before)) is None
+
+
+def test_patched_context_applies_patches_in_order():
+    context = Node('base', {'a': 1})
+    patches = {'10': Node('p10', {'set': {'a': 3}}), '2': Node('p2', {'set': {'a': 2, 'b': 1}})}
+    assert patched_context(context, patches) == {'a': 3, 'b': 1}
+    assert patched_context(context) == {'a': 1}
+
+
+def test_unchanged_keys_do_not_conflict():
+    before = {'a': 1, 'b': 1}
+    merged, conflicts = merge_context_dicts([(before, {'a': 1, 'b': 2}), (before, {'a': 1, 'b': 1, 'c': 3})])
+    assert merged == {'a': 1, 'b': 2, 'c': 3}
+    assert conflicts == []
+
+
+@pytest.mark.parametrize('policy, value, conflicts', [('error', 1, ['a']), ('first', 1, []), ('last', 3, [])])
+def test_conflict_policies(policy, value, conflicts):
+    merged, found = merge_context_dicts([({}, {'a': 1}), ({}, {'a': 2}), ({}, {'a': 3})], policy)
+    assert merged == {'a': value}
+    assert found == conflicts
+
+
+def test_merge_patch_chains_keeps_shared_patches_in_front():
+    base, shared = Node('base', {'a': 0}), patch('shared', {'a': 1})
+    left, right = patch('left', {'b': 1}), patch('right', {'c': 1}, ['a'])
+    chain, conflicts = merge_patch_chains([[base, shared, left], [base, shared, right]])
+    assert [n.uuid for n in chain] == ['base', 'shared', 'left', 'right']
+    assert conflicts == []
+
+
+@pytest.mark.parametrize('policy, order, conflicts', [
+    ('error', ['base', 'left', 'right'], ['a']),
+    ('last', ['base', 'left', 'right'], []),
+    # The patches of the first chain are applied last, so that its values win
+    ('first', ['base', 'right', 'left'], []),
+])
+def test_merge_patch_chains_conflicts(policy, order, conflicts):
+    base = Node('base', {'a': 0})
+    left, right = patch('left', {'a': 1}), patch('right', unset=['a'])
+    chain, found = merge_patch_chains([[base, left], [base, right]], policy)
+    assert [n.uuid for n in chain] == order
+    assert found == conflicts